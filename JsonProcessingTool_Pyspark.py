@@ -3,58 +3,79 @@
 # The code uses PySpark to read in JSON data from a folder, explode the "stats" column, pivot the data by "state", and calculate the time difference between each state. 
 # It then creates a new dataframe containing the time difference between each state transition, and finally uses the "stack" function to reshape the dataframe for further analysis. 
 # The final dataframe has one column for the ID, and one column for each state transition, representing the time difference between the states.
-#e.g python <script.py> -d /path/to/directory -o [<slowest/fastest>
+# The input schema is pinned, metricDF and pipelineStatsDF are cached once for all reports, and --approx switches the percentiles to percentile_approx.
+# Line-delimited input (-f ndjson) can be split by Spark, and --master local[*] runs a local benchmark on all cores.
+# The transitions come from the state graph in pipelines.json, or the file given with --graph.
+#e.g python <script.py> -d /path/to/directory -o [<slowest/fastest> [-f ndjson] [--approx --accuracy 1000] [--master local[*]] [--graph graph.json]
 #################################################################################################################################################################
 
 from pyspark.sql import SparkSession
 from pyspark.sql.functions import *
 from pyspark.sql.window import Window
+from pyspark.sql.types import StructType, StructField, StringType, LongType, ArrayType
 import argparse
 import os
 import time
 
+from pipelines import pipelinesMap, load_pipelines, pipeline_states
+
 start_time = time.time()
 
-# Argparse module to parse command line arguements & it creates argumentparser object & adds 2 argument
+# Argparse module to parse command line arguements & it creates argumentparser object & adds the arguments
 parser = argparse.ArgumentParser()
 parser.add_argument("-d", "--directory", help="Directory containing pipeline stats")
 parser.add_argument("-o", "--option", choices=["slowest", "fastest"], help="Select slowest or fastest pipeline runs")
+parser.add_argument("-f", "--format", choices=["json", "ndjson"], default="json",
+                    help="json: one multi-line document per file (default), ndjson: one document per line, which Spark can split")
+parser.add_argument("--approx", action="store_true", help="use percentile_approx instead of the exact percentile")
+parser.add_argument("--accuracy", type=int, default=10000,
+                    help="accuracy of percentile_approx, the relative error is 1/accuracy (default 10000)")
+parser.add_argument("--master", help="Spark master, e.g. local[*] to benchmark on all local cores")
+parser.add_argument("--graph", help="JSON file with the [from, to] transitions of the state graph (default pipelines.json)")
 #parse_args() method on the parser object to parse the command-line arguments and store the result in the args variable
 args = parser.parse_args()
+if args.graph:
+    pipelinesMap = load_pipelines(args.graph)
 
 #SparkSession is the entry point to the Spark functionality and provides a single point of access to all Spark functionality
 #creates a new Spark session or reuses an existing one
 #sets the name of the Spark application
 #method gets an existing Spark session or creates a new one if none exists
-spark = SparkSession.builder.appName("Json Processing").getOrCreate()
+builder = SparkSession.builder.appName("Json Processing")
+if args.master:
+    builder = builder.master(args.master)
+spark = builder.getOrCreate()
 spark.sparkContext.setLogLevel("ERROR")
 
+#Pinning the schema skips the extra pass over all files that Spark needs to infer it
+statsSchema = StructType([
+    StructField("id", StringType()),
+    StructField("stats", ArrayType(StructType([
+        StructField("state", StringType()),
+        StructField("utcTimeStamp", LongType())])))])
+
+#States of the graph in order, given to pivot so it does not have to collect the distinct states first
+pipelineStates = pipeline_states(pipelinesMap)
+
 folder = args.directory
 
 if os.path.exists(folder):
     # single-line mode can be split into many parts & read in parallel but In multi-line mode file loaded as a
     # whole entity & cannot be split
-    inputDF = spark.read.option("multiline", "true").json(folder)
+    if args.format == "ndjson":
+        inputDF = spark.read.schema(statsSchema).json(folder)
+    else:
+        inputDF = spark.read.schema(statsSchema).option("multiline", "true").json(folder)
     # function takes an array column and creates a new row for each element in the array
-    statsDF = inputDF.select(explode("stats").alias("stats"))
+    statsDF = inputDF.select("id", explode("stats").alias("stats"))
     # Unique values of the "state" column become separate columns,with the earliest "utcTimeStamp" value for each "id" and "state" combination.
-    metricDF = statsDF.groupBy("stats.id").pivot("stats.state").agg(first("stats.utcTimeStamp").alias("utcTimeStamp"))
+    # metricDF is used by every report below, so it is computed once and cached
+    metricDF = statsDF.groupBy("id").pivot("stats.state", pipelineStates)\
+        .agg(first("stats.utcTimeStamp").alias("utcTimeStamp"))\
+        .cache()
 else:
     print("File not found at the given path: ", folder)
 
-#Each tuple in the list represents a transition between two states in a processing pipeline
-pipelinesMap = [("NEW", "QUEUED_FOR_PROCESSING"),
-        ("QUEUED_FOR_PROCESSING", "PRE_PROCESSING"),
-        ("PRE_PROCESSING", "FILE_TO_TIFF_CONVERSION_PROCESSING"),
-        ("FILE_TO_TIFF_CONVERSION_PROCESSING", "FILE_TO_TIFF_CONVERSION_FINISHED"),
-        ("FILE_TO_TIFF_CONVERSION_FINISHED", "OCR_PROCESSING"),
-        ("OCR_PROCESSING", "OCR_FINISHED"),
-        ("OCR_FINISHED", "PRE_PROCESSING_FINISHED"),
-        ("PRE_PROCESSING_FINISHED", "PIPELINE_PROCESSING"),
-        ("PIPELINE_PROCESSING", "PIPELINE_FINISHED"),
-        ("PIPELINE_FINISHED", "POST_PROCESSING"),
-        ("POST_PROCESSING", "DOCUMENT_PROCESSED")]
-
 #Loops through the list of tuples,for each tuple adds a new column
 #The name of the new column is a concatenation of the two state names
 #The value in the new column is the difference between the timestamps in the two states
@@ -68,32 +89,30 @@ pipelineDF = pipelineDF.select("id",
                                *[f"{v1}____{v2}" for (v1, v2) in pipelinesMap]
                               )
 
-pipelineStatsDF = pipelineDF.select(col("ID"),
-                                    expr("stack(11, " +
-                                         "'A.NEW -> QUEUED_FOR_PROCESSING', NEW____QUEUED_FOR_PROCESSING, " +
-                                         "'B.QUEUED_FOR_PROCESSING -> PRE_PROCESSING', QUEUED_FOR_PROCESSING____PRE_PROCESSING, " +
-                                         "'C.PRE_PROCESSING -> FILE_TO_TIFF_CONVERSION_PROCESSING', PRE_PROCESSING____FILE_TO_TIFF_CONVERSION_PROCESSING, " +
-                                         "'D.FILE_TO_TIFF_CONVERSION_PROCESSING -> FILE_TO_TIFF_CONVERSION_FINISHED', FILE_TO_TIFF_CONVERSION_PROCESSING____FILE_TO_TIFF_CONVERSION_FINISHED, " +
-                                         "'E.FILE_TO_TIFF_CONVERSION_FINISHED -> OCR_PROCESSING', FILE_TO_TIFF_CONVERSION_FINISHED____OCR_PROCESSING, " +
-                                         "'F.OCR_PROCESSING -> OCR_FINISHED', OCR_PROCESSING____OCR_FINISHED, " +
-                                         "'G.OCR_FINISHED -> PRE_PROCESSING_FINISHED', OCR_FINISHED____PRE_PROCESSING_FINISHED, " +
-                                         "'H.PRE_PROCESSING_FINISHED -> PIPELINE_PROCESSING', PRE_PROCESSING_FINISHED____PIPELINE_PROCESSING, " +
-                                         "'I.PIPELINE_PROCESSING -> PIPELINE_FINISHED', PIPELINE_PROCESSING____PIPELINE_FINISHED, " +
-                                         "'J.PIPELINE_FINISHED -> POST_PROCESSING', PIPELINE_FINISHED____POST_PROCESSING, " +
-                                         "'K.POST_PROCESSING -> DOCUMENT_PROCESSED', POST_PROCESSING____DOCUMENT_PROCESSED " +
-                                         ") as (PIPELINE, Time)"))
+#Stacks the step columns into (PIPELINE, Time) rows, the step names are prefixed with 000., 001., ... so they sort in pipeline order
+#for any number of steps and stay plain characters inside the SQL string literal
+stackExpr = ", ".join(f"'{i:03d}.{v1} -> {v2}', {v1}____{v2}" for i, (v1, v2) in enumerate(pipelinesMap))
+pipelineStatsDF = pipelineDF.select(col("ID"), expr(f"stack({len(pipelinesMap)}, {stackExpr}) as (PIPELINE, Time)"))\
+    .cache()
 
 #"Time" represents the name of a column which contains numerical values
 aggColumn = "Time"
 
 print("Task 1:\nProcess all files and present a statistic about the runtimes per pipeline step (min, max, 10%/50%/90% percentile and mean).")
+#The three percentiles are computed by a single aggregate, exactly or with percentile_approx
+if args.approx:
+    percentiles = expr(f"percentile_approx({aggColumn}, array(0.1, 0.5, 0.9), {args.accuracy})")
+else:
+    percentiles = expr(f"percentile({aggColumn}, array(0.1, 0.5, 0.9))")
 pipelineStatsDF.groupBy("PIPELINE").agg(
     min(aggColumn).alias("min"),
     max(aggColumn).alias("max"),
     mean(aggColumn).alias("mean"),
-    expr(f"percentile({aggColumn}, 0.1)").alias("percentile10"),
-    expr(f"percentile({aggColumn}, 0.5)").alias("percentile50"),
-    expr(f"percentile({aggColumn}, 0.9)").alias("percentile90"))\
+    percentiles.alias("percentiles"))\
+    .select("PIPELINE", "min", "max", "mean",
+            col("percentiles")[0].alias("percentile10"),
+            col("percentiles")[1].alias("percentile50"),
+            col("percentiles")[2].alias("percentile90"))\
     .orderBy("PIPELINE")\
     .show(100, False)
 # .select("PIPELINE",
@@ -125,11 +144,10 @@ try:
             .where("rank < 6") \
             .orderBy(col("PIPELINE"), col("Time").desc())
     else:
-        raise ValueError(f"Invalid option: {option}")
-except Exception as e:
-    print(f"An unknown error occurred while processing the {option} pipeline: {e}")
-finally:
+        raise ValueError(f"Invalid option: {args.option}")
     top_pipeline_df.show(100, False)
+except Exception as e:
+    print(f"An unknown error occurred while processing the {args.option} pipeline: {e}")
 
 print("Task 2b:\nShow the total processing time(ms) between the states: PRE_PROCESSING -> PIPELINE_FINISHED")
 # It creates a new column "PROCESSING_TIME" by subtracting the value in the "PRE_PROCESSING" column from the value in the
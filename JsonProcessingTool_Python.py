@@ -1,109 +1,1979 @@
 ##############################################################################################################################################################################
 #Python
-#This script is a command-line tool that processes JSON files in a given directory. The script first creates two dictionaries to store timestamps for each state and runtimes for each
-# pipeline step.It calculates statistics such as the minimum, maximum, median, and mean runtimes for each pipeline step and prints them.
+#This script is a command-line tool that processes JSON files in a given directory. For each document it takes the first timestamp of every state and computes
+# the runtime of each transition of the state graph (pipelines.json) inside that document, so file order and missing or repeated states do not mix up
+# documents. It calculates statistics such as the minimum, maximum, median, and mean runtimes for each pipeline step and prints them, along with the
+# number of incomplete documents, which lack at least one state of the graph.
 
-#The script also has a Task 2 which sorts the processing times by value in descending order and show the top 5 slowest IDs or sorts the processing times by value in ascending order
-# and show the top 5 fastest IDs based on the option passed in the command line.
+#The script also has a Task 2 which shows the top 5 slowest or fastest IDs by total processing time based on the option passed in the command line,
+# and a Task 2a which shows the top 5 slowest or fastest IDs per pipeline step. Both are collected with bounded heaps while the files are parsed.
 
 #The script takes two command-line arguments:
-#-d: The directory to process.
+#-d: The directory to process. A .tar, .tar.gz, .zip or .ndjson(.gz) file is read too, member by member (line by line
+#     for NDJSON) without extracting it. Archives are streamed in one process, so -w, --cache and --read-ahead do not apply.
 #-o : sort by slowest or fastest.
-# eg python <script.py> -d /path/to/directory -o <slowest/fastest>
+#-e : engine, python (this script, default), pandas (Test.py) or spark (JsonProcessingTool_Pyspark.py). The pandas and spark engines
+#     share the state graph of pipelines.py and only take -d, -o, --graph (and -k for pandas); --watch, -s, --exact, -w,
+#     --cache, --profile and --index are refused with them.
+#--graph : JSON file with the [from, to] transitions of the state graph, in report order. Default pipelines.json.
+#-w : optional number of worker processes. The file list is split into slices that are parsed in parallel and the partial
+#     aggregates are merged back in listing order. Each worker sends back one sketch per step (every runtime with --exact),
+#     so counts, min, max, mean and the top IDs are the same as with a single process. With --exact the output is identical;
+#     by default the percentiles stay within the error of the sketch but can differ with the number of slices.
+#--exact : keep every runtime and compute exact percentiles. By default the percentiles come from a quantile sketch
+#     that uses constant memory per pipeline step (min, max and mean stay exact).
+#--error : rank error bound of the quantile sketch, default 0.01.
+#-k : number of slowest/fastest IDs to show, default 5.
+#--cache : directory keeping the parsed records of every file, keyed by path, size and mtime, one file per directory of
+#     metrics. Later runs only parse the files that are new or changed, e.g. --cache .jsonproc-cache
+#--decoder : JSON backend, json or orjson. By default orjson is used when it is installed. Files are read in one call
+#     (memory-mapped when they are 1 MB or more) and the parse throughput in MB/s is printed after the report.
+#--read-ahead : number of files read ahead on a thread pool while the parser decodes the current one, for storage with
+#     a high latency per file such as NFS. The files are still parsed in listing order, default 0 (off).
+#--read-ahead-memory : cap in MB on the bytes of the files read ahead or being read and not parsed yet, default 64. A file
+#     bigger than the cap is still read, one at a time.
+#-s : columnar store (see the compact subcommand). The new files of the directory are appended to it as a segment and
+#     the report is computed from the store with vectorized NumPy. Percentiles from the store are always exact.
+#     Without -d the store is read as it is, without looking at the directory.
+#--index : rollup index file. The new files of the directory are added to per minute, hour and day cells of each pipeline
+#     step (count, sum, min, max, quantile sketch and top k ids), and the report is computed by merging the cells of the
+#     time range given with --from/--to (ISO date and time in UTC, or ms; the whole index by default), so it does not
+#     rescan the directory. Percentiles come from the sketches, with the --error the index was built with (another
+#     --error is refused), and -k cannot exceed the -k the index was built with. --bucket minute|hour|day prints one report per bucket of the range instead, e.g.
+#     --index metrics.idx --from 2020-01-15T14:00 --to 2020-01-15T15:00 -o slowest
+#     Without -d the index is queried as it is, without looking at the directory.
+#--profile : write the time spent listing, reading, decoding, aggregating, computing the statistics and printing the
+#     report, with files/s, bytes/s, error count and peak RSS, as a JSON document to a file ('-' prints it).
+#--log-level : level of script.log, default INFO. Log records go through a queue to a background thread. The per-file
+#     messages are DEBUG, so they only cost anything when asked for with --log-level DEBUG.
+#--watch : stay resident, add new files as they land and print the updated report. With --socket PATH the statistics
+#     can be queried over a Unix domain socket by sending "stats", "top" or "status" lines, e.g.
+#     echo stats | nc -U /tmp/jsonproc.sock
+#--interval : seconds between two polls of the directory in watch mode, default 1. The directory is listed again when its
+#     mtime changes and every 10 polls whatever its mtime, since NFS attribute caching and coarse timestamps can hide a file.
+# eg python <script.py> -d /path/to/directory -o <slowest/fastest> [-w 8] [--exact | --error 0.005] [-k 10]
+#
+#The compact subcommand turns a directory into a columnar store of .npy segments, appending only the files it has not seen:
+# eg python <script.py> compact -d /path/to/directory -s /path/to/store
+#
+#The map and reduce subcommands scale out over several hosts or cron slots without Spark. map summarizes a shard of the
+#files, chosen with --glob and/or a hash --partition INDEX/COUNT, into a partial aggregate file (gzipped JSON): per step counts,
+#sum, min, max, a quantile sketch (--error) and the top k slowest and fastest IDs. reduce merges any number of them into the
+#Task 1/Task 2 report, with sketch percentiles as with the default mode. All the shards need the same graph and --error.
+# eg python <script.py> map -d /path/to/directory --partition 0/4 -p shard0.part [-w 8] [-k 10]
+#    python <script.py> reduce -o <slowest/fastest> shard0.part shard1.part shard2.part shard3.part
 ##################################################################################################################################################################################
 import argparse
 import json
 import os
-from datetime import datetime
-import statistics
+import sys
+import runpy
+from datetime import datetime, timezone
 import numpy as np
 import logging
+import logging.handlers
 import time
+import math
+import heapq
+import mmap
+import atexit
+import queue
+import contextlib
+import multiprocessing
+import resource
+import signal
+import stat
+import socketserver
+import threading
+import random
+import array
+import sqlite3
+import gc
+import hashlib
+import gzip
+import tarfile
+import zipfile
+import zlib
+import fnmatch
+import itertools
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from pipelines import pipelinesMap, load_pipelines, pipeline_states
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 start_time = time.time()
 
-logging.basicConfig(filename='script.log', level=logging.INFO)
+# Handler writing script.log once setup_logging has been called, and the queue the worker processes log into
+log_handler = None
+worker_log_queue = None
 
-def process_directory(directory, option):
-    # Create a dictionary to store the timestamps for each state
-    state_timestamps = {}
 
-    # Create a dictionary to store the runtimes for each pipeline step
-    pipeline_runtimes = {}
-    processing_times = {}
+# Send the log records through a queue to a listener thread that writes script.log, so the ingestion loop never waits
+# on the file. The per-file messages are DEBUG, so they are skipped altogether unless asked for with --log-level.
+def setup_logging(level="INFO", filename='script.log'):
+    global log_handler
+    log_handler = logging.FileHandler(filename)
+    log_handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, log_handler)
+    listener.start()
+    atexit.register(listener.stop)
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
 
-    logging.info('Start processing directory: %s', directory)
-    # Get a list of all the JSON files in the directory
-    for filename in os.listdir(directory):
-        if filename.endswith('.json'):
-            logging.info('Processing file: %s', filename)
+
+# Runs in each worker process: log into the queue of the main process, if it has one. The workers of a resident pool
+# (watch mode) ignore Ctrl-C and SIGTERM, which reach the whole process group; the main process shuts them down.
+def setup_worker(log_queue, level, resident=False):
+    if resident:
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    if log_queue is not None:
+        root = logging.getLogger()
+        root.handlers = [logging.handlers.QueueHandler(log_queue)]
+        root.setLevel(level)
+
+
+def worker_pool(workers, resident=False):
+    global worker_log_queue
+    if log_handler is not None and worker_log_queue is None:
+        # Only created once a pool is needed, a process-safe queue costs more per record than the in-process one
+        worker_log_queue = multiprocessing.Queue(-1)
+        listener = logging.handlers.QueueListener(worker_log_queue, log_handler)
+        listener.start()
+        atexit.register(listener.stop)
+    return ProcessPoolExecutor(max_workers=workers, initializer=setup_worker,
+                               initargs=(worker_log_queue, logging.getLogger().level, resident))
+
+
+# Backends turning the bytes of one file into the decoded document. orjson is used when it is installed.
+DECODERS = {"json": json.loads}
+if orjson is not None:
+    DECODERS["orjson"] = orjson.loads
+
+# Files at least this big are memory-mapped instead of read into a buffer
+MMAP_THRESHOLD = 1 << 20
+
+# Default cap on the bytes read ahead and not parsed yet
+READ_AHEAD_MEMORY = 64 << 20
+
+
+# Inputs that -d accepts besides a directory, read member by member (or line by line for NDJSON) without extracting them
+ARCHIVE_SUFFIXES = ('.tar', '.tar.gz', '.tgz', '.zip', '.ndjson', '.ndjson.gz')
+
+
+def is_archive(path):
+    return path.endswith(ARCHIVE_SUFFIXES) and os.path.isfile(path)
+
+
+# Yield (name, content) for each document of an archive in the order it is stored. Tar files are read as a stream, so
+# a .tar.gz is decompressed once front to back; NDJSON members are named after the file and the line number.
+def iter_members(path):
+    if path.endswith(('.ndjson', '.ndjson.gz')):
+        opener = gzip.open if path.endswith('.gz') else open
+        name = os.path.basename(path)
+        with opener(path, 'rb') as ndjson_file:
+            for line_number, line in enumerate(ndjson_file, 1):
+                if line.strip():
+                    yield '{}:{}'.format(name, line_number), line
+    elif path.endswith('.zip'):
+        with zipfile.ZipFile(path) as zip_file:
+            for info in zip_file.infolist():
+                if not info.is_dir() and info.filename.endswith('.json'):
+                    yield info.filename, zip_file.read(info)
+    else:
+        with tarfile.open(path, mode='r|*') as tar_file:
+            for member in tar_file:
+                if member.isfile() and member.name.endswith('.json'):
+                    yield member.name, tar_file.extractfile(member).read()
+
+
+# Names of the .json files of a directory in listing order. os.scandir gives the file type along with the name, so
+# entries that are not files are skipped without a stat call per entry.
+def list_json_files(directory):
+    with os.scandir(directory) as entries:
+        return [entry.name for entry in entries if entry.name.endswith('.json') and entry.is_file()]
+
+
+# Reads and decodes the files with one of the DECODERS, and keeps the bytes and time it spent on them so the
+# backends can be compared on real data. With read_ahead the next files are read on a pool of that many threads while
+# the current one is decoded, reserving at most read_ahead_memory bytes for the files read ahead and not parsed yet.
+class Decoder:
+    def __init__(self, name="auto", read_ahead=0, read_ahead_memory=READ_AHEAD_MEMORY):
+        if name == "auto":
+            name = "orjson" if "orjson" in DECODERS else "json"
+        if name not in DECODERS:
+            raise ValueError("Decoder not available: {}".format(name))
+        self.name = name
+        self.decode = DECODERS[name]
+        self.read_ahead = read_ahead
+        self.read_ahead_memory = read_ahead_memory
+        self.files = 0
+        self.bytes = 0
+        self.read_seconds = 0.0
+        self.decode_seconds = 0.0
+        # Files that could not be read or decoded
+        self.errors = 0
+
+    # A decoder with the same backend and empty counters, to be sent to a worker process
+    def fresh(self):
+        return Decoder(self.name, self.read_ahead, self.read_ahead_memory)
+
+    def add_counters(self, other):
+        self.files += other.files
+        self.bytes += other.bytes
+        self.read_seconds += other.read_seconds
+        self.decode_seconds += other.decode_seconds
+        self.errors += other.errors
+
+    # Open and parse one JSON file, returning its id and the (state, timestamp) pairs of its stats. A file is counted
+    # with its bytes and times once it is open, whether it decodes or not, so the throughput covers the malformed
+    # files too.
+    def parse(self, path):
+        started = time.perf_counter()
+        read = None
+        try:
+            with open(path, 'rb') as json_file:
+                size = os.fstat(json_file.fileno()).st_size
+                self.files += 1
+                self.bytes += size
+                if size >= MMAP_THRESHOLD:
+                    # orjson decodes straight from the mapping, the json module needs a bytes copy of it
+                    with mmap.mmap(json_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                        read = time.perf_counter()
+                        if self.name == "orjson":
+                            with memoryview(mapped) as view:
+                                data = self.decode(view)
+                        else:
+                            data = self.decode(mapped[:])
+                else:
+                    # Read the whole file in one call
+                    content = json_file.read()
+                    read = time.perf_counter()
+                    data = self.decode(content) # Takes bytes and return json object
+                return self.record(data)
+        finally:
+            if read is not None:
+                self.read_seconds += read - started
+                self.decode_seconds += time.perf_counter() - read
+
+    # Parse content that has been read already, `read_seconds` being the time it took to get it
+    def parse_content(self, content, read_seconds):
+        self.files += 1
+        self.bytes += len(content)
+        self.read_seconds += read_seconds
+        started = time.perf_counter()
+        try:
+            return self.record(self.decode(content))
+        finally:
+            self.decode_seconds += time.perf_counter() - started
+
+    # Only the id and the state/utcTimeStamp of each stats entry are used
+    @staticmethod
+    def record(data):
+        return data["id"], [(stat['state'], stat['utcTimeStamp']) for stat in data['stats']]
+
+    # Parse the files in order, yielding (filename, record) or (filename, exception) for the files that cannot be read
+    # or decoded
+    def parse_all(self, directory, filenames):
+        if self.read_ahead <= 0:
+            for filename in filenames:
+                try:
+                    yield filename, self.parse(os.path.join(directory, filename))
+                except Exception as e:
+                    yield filename, e
+            return
+
+        # Each reader thread takes the size of its file from the open file and reserves it from the cap before reading,
+        # so reads in flight count too. Reservations are granted in listing order, and the oldest one goes through
+        # whatever its size once nothing else is reserved, so the file the parser waits for is never held up by later
+        # ones. A file that cannot be opened reserves nothing.
+        condition = threading.Condition()
+        state = {"reserved": 0, "turn": 0, "closed": False}
+
+        # Wait for the turn of the file at this position of the listing, then reserve its size
+        def reserve(position, size):
+            with condition:
+                condition.wait_for(lambda: state["closed"] or state["turn"] == position and
+                                   (not state["reserved"] or state["reserved"] + size <= self.read_ahead_memory))
+                state["reserved"] += size
+                state["turn"] += 1
+                condition.notify_all()
+
+        def release(size):
+            with condition:
+                state["reserved"] -= size
+                condition.notify_all()
+
+        def read_file(position, filename):
+            size = 0
+            try:
+                json_file = open(os.path.join(directory, filename), 'rb')
+            except OSError:
+                reserve(position, 0)
+                raise
+            with json_file:
+                try:
+                    size = os.fstat(json_file.fileno()).st_size
+                finally:
+                    reserve(position, size)
+                try:
+                    return json_file.read(), size
+                except Exception:
+                    release(size)
+                    raise
+
+        pending = deque()
+        submitted = 0
+        with ThreadPoolExecutor(max_workers=self.read_ahead) as executor:
             try:
-                # Open and parse the JSON file
-                with open(os.path.join(directory, filename)) as json_file:
-                    data = json.load(json_file) # Takes string and return json object
-                    id = data["id"]
-
-                    # Initialize the processing time for this id to 0
-                    processing_times[id] = 0
-
-                # Extract the timestamp and state
-                for stat in data['stats']:
-                    timestamp = stat['utcTimeStamp']
-                    state = stat['state']
-                    # Add the timestamp to the list for the corresponding state
-                    if state not in state_timestamps:
-                        state_timestamps[state] = []
-                    state_timestamps[state].append(timestamp)
-
-                    if state == "PRE_PROCESSING":
-                        start_time = timestamp
-                    elif state == "PIPELINE_FINISHED":
-                        end_time = timestamp
-                        processing_times[id] += end_time - start_time
+                while submitted < len(filenames) or pending:
+                    # Keep up to read_ahead files in flight, the readers wait for room under the memory cap
+                    while submitted < len(filenames) and len(pending) < self.read_ahead:
+                        pending.append((filenames[submitted], executor.submit(read_file, submitted, filenames[submitted])))
+                        submitted += 1
+                    filename, future = pending.popleft()
+                    # The read time is the time the parser waited for the file, the rest overlapped with decoding
+                    started = time.perf_counter()
+                    try:
+                        content, size = future.result()
+                    except Exception as e:
+                        yield filename, e
+                        continue
+                    try:
+                        record = self.parse_content(content, time.perf_counter() - started)
+                    except Exception as e:
+                        record = e
+                    finally:
+                        release(size)
+                    yield filename, record
+            finally:
+                # Let the readers still waiting for room finish when the parse stops early
+                with condition:
+                    state["closed"] = True
+                    condition.notify_all()
+                for _, future in pending:
+                    future.cancel()
 
+    # Parse the documents of an archive or NDJSON file in the order they are stored, yielding (name, record) or
+    # (name, exception) like parse_all. The read time includes decompressing the members. With `select` only the
+    # members whose name it accepts are decoded.
+    def parse_archive(self, path, select=None):
+        members = iter_members(path)
+        while True:
+            started = time.perf_counter()
+            try:
+                name, content = next(members)
+            except StopIteration:
+                return
+            if select is not None and not select(name):
+                continue
+            try:
+                yield name, self.parse_content(content, time.perf_counter() - started)
             except Exception as e:
-                logging.error("Error processing file: %s. Error: %s", filename, str(e))
-
-    # Calculate the runtimes for each pipeline step
-    for i in range(1, len(state_timestamps)):
-        current_state = list(state_timestamps.keys())[i]
-        previous_state = list(state_timestamps.keys())[i-1]
-        runtimes = [state_timestamps[current_state][j] - state_timestamps[previous_state][j] for j in range(len(state_timestamps[current_state]))]
-        pipeline_runtimes[previous_state + ' -> ' + current_state] = runtimes
-
-    # Calculate the statistics for each pipeline step
-    print(
-        "Task 1:\nProcess all files and present a statistic about the runtimes per pipeline step (min, max, 10%/50%/90% percentile and mean).\n")
-    for pipeline_step, runtimes in pipeline_runtimes.items():
-        min_runtime = min(runtimes)
-        max_runtime = max(runtimes)
-        mean_runtime = statistics.mean(runtimes)
-        percentile10 = np.percentile(runtimes, 10)
-        percentile50 = np.percentile(runtimes, 50)
-        percentile90 = np.percentile(runtimes, 90)
-        print(f'{pipeline_step} : {min_runtime}s {max_runtime}s {mean_runtime}s {percentile10}s {percentile50}s {percentile90}s')
-
-    #Task2
-    sorted_times = sorted(processing_times.items(), key=lambda x: x[1], reverse=(option == "slowest"))
-    print("\nTask 2:\nShow the top 5 {} IDs & total processing time between the states:".format(option))
-    for i in range(5):
-        if i >= len(sorted_times):
-            print("IndexError: list index out of range")
-            break
-        id, time = sorted_times[i]
-        print(f'{"ID"}:{id}, {"PROCESSING_TIME"}:{time}')
-        # print("ID:", id)
-        # print("Total processing time :", time)
+                yield name, e
+
+    def print_throughput(self):
+        megabytes = self.bytes / 1e6
+        seconds = self.read_seconds + self.decode_seconds
+        print("Parse throughput ({}): {} files, {:.2f} MB, read {:.2f}s, decode {:.2f}s, {:.2f} MB/s".format(
+            self.name, self.files, megabytes, self.read_seconds, self.decode_seconds,
+            megabytes / seconds if seconds else 0.0))
+
+
+# Number of files given with --read-ahead, 0 for off
+def parse_read_ahead(value):
+    try:
+        read_ahead = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected a whole number: {}".format(value))
+    if read_ahead < 0:
+        raise argparse.ArgumentTypeError("the number of files cannot be negative: {}".format(value))
+    return read_ahead
+
+
+# MB given with --read-ahead-memory, at least 1
+def parse_read_ahead_memory(value):
+    try:
+        megabytes = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected a whole number: {}".format(value))
+    if megabytes < 1:
+        raise argparse.ArgumentTypeError("the cap must be at least 1 MB: {}".format(value))
+    return megabytes
+
+
+# Parse the given files in listing order, yielding (id, stats) and logging the files that cannot be read
+def iter_records(directory, filenames, decoder):
+    for filename, record in decoder.parse_all(directory, filenames):
+        logging.debug('Processing file: %s', filename)
+        if isinstance(record, Exception):
+            decoder.errors += 1
+            logging.error("Error processing file: %s. Error: %s", filename, str(record))
+        else:
+            yield record
+
+
+# Total processing time of one document between the states PRE_PROCESSING -> PIPELINE_FINISHED
+def processing_time(stats):
+    processing_time = 0
+    start_time = None
+    for state, timestamp in stats:
+        if state == "PRE_PROCESSING":
+            start_time = timestamp
+        elif state == "PIPELINE_FINISHED" and start_time is not None:
+            processing_time += timestamp - start_time
+    return processing_time
+
+
+# Fill the partial aggregate (see Aggregate.partial) with a slice of the directory listing: the runtimes of each
+# transition and the top k ids of the slice, returned along with the decoder and its counters. Runs inside the worker
+# processes when --workers is used.
+def process_files(directory, filenames, partial, decoder):
+    for id, stats in iter_records(directory, filenames, decoder):
+        partial.add_record(id, stats)
+    return partial, decoder
+
+
+# Parse a slice of the listing for the cache, returning (filename, record) with None for files that cannot be read,
+# along with the decoder and its counters
+def parse_files(directory, filenames, decoder):
+    records = []
+    for filename, record in decoder.parse_all(directory, filenames):
+        logging.debug('Processing file: %s', filename)
+        if isinstance(record, Exception):
+            decoder.errors += 1
+            logging.error("Error processing file: %s. Error: %s", filename, str(record))
+            record = None
+        records.append((filename, record))
+    return records, decoder
+
+
+# parse_files over the whole batch, split across a process pool when there is more than one worker. A resident caller
+# passes the pool it keeps as `executor`, otherwise one is started for the batch.
+def parse_batch(directory, filenames, decoder, workers=1, executor=None):
+    if workers > 1 and len(filenames) > 1:
+        chunks = split_files(filenames, workers)
+        records = []
+        with contextlib.nullcontext(executor) if executor is not None else worker_pool(workers) as executor:
+            for partial_records, partial_decoder in executor.map(parse_files, [directory] * len(chunks), chunks,
+                                                                 [decoder.fresh() for _ in chunks]):
+                records.extend(partial_records)
+                decoder.add_counters(partial_decoder)
+        return records
+    return parse_files(directory, filenames, decoder)[0]
+
+
+# Parse the documents of an archive, yielding (name, record) with None for the ones that cannot be decoded, like
+# cached_records. Archives are streamed in a single process whatever the number of workers.
+def archive_records(path, decoder, select=None):
+    for name, record in decoder.parse_archive(path, select):
+        logging.debug('Processing member: %s', name)
+        if isinstance(record, Exception):
+            decoder.errors += 1
+            logging.error("Error processing member: %s. Error: %s", name, str(record))
+            record = None
+        yield name, record
+
+
+# Keep the cyclic garbage collector off while a batch of small objects is built. None of them are part of a cycle, so
+# there is no point in going over all of them again and again while they pile up.
+@contextlib.contextmanager
+def gc_paused():
+    collecting = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if collecting:
+            gc.enable()
+
+
+# Size and mtime_ns of each .json file of a directory, from the os.scandir entries
+def json_file_signatures(directory):
+    signatures = {}
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.name.endswith('.json') and entry.is_file():
+                try:
+                    file_stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                signatures[entry.name] = (file_stat.st_size, file_stat.st_mtime_ns)
+    return signatures
+
+
+# The cache is a directory with one file per directory of metrics, named after a hash of its absolute path, so a run
+# only loads the entries of the directory it reads. A file maps each filename to (size, mtime, (id, stats)), stored
+# column by column in an .npz: the sizes, mtimes, state codes and timestamps are NumPy arrays, which load in one copy
+# each, and the stats of each file are the slice between two offsets. The filenames, ids and state names are a JSON
+# document kept as bytes in the "names" array, so the cache is read with allow_pickle=False and never unpickles.
+def cache_file_path(cache_path, absolute_directory):
+    return os.path.join(cache_path, hashlib.sha1(absolute_directory.encode()).hexdigest() + '.npz')
+
+
+def load_cache(cache_path, absolute_directory):
+    try:
+        with np.load(cache_file_path(cache_path, absolute_directory), allow_pickle=False) as cache_file:
+            columns = {name: cache_file[name] for name in cache_file.files}
+        names = json.loads(columns["names"].tobytes())
+    except (FileNotFoundError, NotADirectoryError):
+        return {}
+    except Exception as e:
+        logging.error("Error reading cache: %s. Error: %s", cache_path, str(e))
+        return {}
+    with gc_paused():
+        states = np.array(names["states"], dtype=object)[columns["codes"]].tolist()
+        timestamps = columns["timestamps"].tolist() if "timestamps" in columns else names["timestamps"]
+        offsets = columns["offsets"].tolist()
+        return {filename: (size, mtime, (id, list(zip(states[a:b], timestamps[a:b]))))
+                for filename, size, mtime, id, a, b in zip(names["filenames"], columns["sizes"].tolist(),
+                                                           columns["mtimes"].tolist(), names["ids"], offsets, offsets[1:])}
+
+
+def save_cache(cache_path, absolute_directory, entries):
+    os.makedirs(cache_path, exist_ok=True)
+    state_codes = {}
+    codes, timestamps, offsets, ids = [], [], [0], []
+    for size, mtime, (id, stats) in entries.values():
+        ids.append(id)
+        for state, timestamp in stats:
+            codes.append(state_codes.setdefault(state, len(state_codes)))
+            timestamps.append(timestamp)
+        offsets.append(len(codes))
+    names = {"directory": absolute_directory, "filenames": list(entries), "ids": ids, "states": list(state_codes)}
+    columns = {"sizes": np.array([entry[0] for entry in entries.values()], dtype=np.int64),
+               "mtimes": np.array([entry[1] for entry in entries.values()], dtype=np.int64),
+               "codes": np.array(codes, dtype=np.int32),
+               "offsets": np.array(offsets, dtype=np.int64)}
+    timestamp_array = np.array(timestamps)
+    if timestamp_array.dtype.kind == 'i':
+        columns["timestamps"] = timestamp_array.astype(np.int64)
+    else:
+        # Kept in the JSON when some timestamp is not an integer, so the records come back unchanged
+        names["timestamps"] = timestamps
+    columns["names"] = np.frombuffer(json.dumps(names).encode(), dtype=np.uint8)
+    # Write next to the cache and rename it, so an interrupted run never leaves a truncated cache behind
+    path = cache_file_path(cache_path, absolute_directory)
+    with open(path + '.tmp', 'wb') as cache_file:
+        np.savez(cache_file, **columns)
+    os.replace(path + '.tmp', path)
+
+
+# Yield (filename, record) for the files in listing order, with None for files that cannot be read. Only the files that
+# are new or whose size or mtime changed since the cache was written are parsed, the entries of files that were
+# removed from the directory are dropped, and the cache is only written back when one of them changed it.
+def cached_records(directory, filenames, cache_path, decoder, workers=1, executor=None):
+    absolute_directory = os.path.abspath(directory)
+    cache = load_cache(cache_path, absolute_directory)
+    signatures = json_file_signatures(directory)
+    entries = {filename: entry for filename, entry in cache.items() if filename in signatures}
+    changed = len(entries) != len(cache)
+    misses = [filename for filename in filenames
+              if filename not in entries or entries[filename][:2] != signatures.get(filename)]
+
+    logging.info('Cache hits: %d, files to parse: %d', len(filenames) - len(misses), len(misses))
+    # Records of files that were removed while they were parsed are used once and not cached
+    uncached = {}
+    for filename, record in parse_batch(directory, misses, decoder, workers, executor):
+        if record is None:
+            changed = entries.pop(filename, None) is not None or changed
+        elif filename in signatures:
+            entries[filename] = signatures[filename] + (record,)
+            changed = True
+        else:
+            uncached[filename] = record
+    if changed:
+        save_cache(cache_path, absolute_directory, entries)
+
+    for filename in filenames:
+        entry = entries.get(filename)
+        yield filename, uncached.get(filename) if entry is None else entry[2]
+
+
+# Split the listing into contiguous slices, a few per worker so that slow slices do not hold up the pool
+def split_files(filenames, workers):
+    chunk_count = min(len(filenames), workers * 4) or 1
+    chunk_size = -(-len(filenames) // chunk_count)
+    return [filenames[i:i + chunk_size] for i in range(0, len(filenames), chunk_size)]
+
+
+# KLL quantile sketch (Karnin, Lang & Liberty). Values are kept in a stack of compactors; when a level is full it is
+# sorted and every second value is promoted to the next level with double the weight. Memory is O(k) whatever the
+# number of values, and the rank error of a quantile is roughly `error` (k is derived from it).
+class QuantileSketch:
+    def __init__(self, error=0.01):
+        self.k = max(8, int(math.ceil(3.3 / error)))
+        self.compactors = []
+        self.size = 0
+        self.max_size = 0
+        # Fixed seed so that the same input always gives the same report. The generator is only created on the first
+        # compaction, small sketches never need one.
+        self.seed = 0
+        self.random = None
+        self.grow()
+
+    def grow(self):
+        self.compactors.append([])
+        self.max_size = sum(self.capacity(level) for level in range(len(self.compactors)))
+
+    def capacity(self, level):
+        depth = len(self.compactors) - level - 1
+        return int(math.ceil((2 / 3) ** depth * self.k)) + 1
+
+    def add(self, value):
+        self.compactors[0].append(value)
+        self.size += 1
+        if self.size >= self.max_size:
+            self.compress()
+
+    def compress(self):
+        for level in range(len(self.compactors)):
+            if len(self.compactors[level]) >= self.capacity(level):
+                if level + 1 >= len(self.compactors):
+                    self.grow()
+                if self.random is None:
+                    self.random = random.Random(self.seed)
+                values = sorted(self.compactors[level])
+                # An odd value out stays on its level, the rest is halved into the next one
+                self.compactors[level] = [values.pop()] if len(values) % 2 else []
+                self.compactors[level + 1].extend(values[self.random.randint(0, 1)::2])
+                self.size = sum(len(compactor) for compactor in self.compactors)
+                if self.size < self.max_size:
+                    break
+
+    # Add a batch of values at once, compacting only when the batch is in
+    def extend(self, values):
+        self.compactors[0].extend(values)
+        self.size += len(values)
+        while self.size >= self.max_size:
+            self.compress()
+
+    # Add the values of another sketch built with the same error, as if they had been added to this one
+    def merge(self, other):
+        while len(self.compactors) < len(other.compactors):
+            self.grow()
+        for level, compactor in enumerate(other.compactors):
+            self.compactors[level].extend(compactor)
+        self.size = sum(len(compactor) for compactor in self.compactors)
+        while self.size >= self.max_size:
+            self.compress()
+
+    # Take over compactors saved from another sketch with the same error, e.g. a cell of the rollup index. The random
+    # generator is seeded from the number of values held, so a restored sketch still compacts the same way every time.
+    def restore(self, compactors):
+        self.compactors = compactors
+        self.size = sum(len(compactor) for compactor in self.compactors)
+        self.max_size = sum(self.capacity(level) for level in range(len(self.compactors)))
+        self.seed = self.size
+        self.random = None
+
+    def quantile(self, q):
+        weighted = sorted((value, 2 ** level) for level, compactor in enumerate(self.compactors) for value in compactor)
+        total = sum(weight for _, weight in weighted)
+        rank = 0
+        for value, weight in weighted:
+            rank += weight
+            if rank >= q * total:
+                return value
+        return weighted[-1][0] if weighted else None
+
+
+# Rank error of the quantile sketch given with --error, between 0 and 1 excluded
+def parse_error(value):
+    try:
+        error = float(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected a number: {}".format(value))
+    if not 0 < error < 1:
+        raise argparse.ArgumentTypeError("the error must be between 0 and 1 excluded: {}".format(value))
+    return error
+
+
+# Columnar store. A compacted directory is kept as a list of append-only segments, each one a folder of .npy columns:
+#   timestamps.npy        int64, one per stats entry (event), in listing order then stats order
+#   states.npy            int16 code of the state of each event, decoded with manifest["states"]
+#   documents.npy         int32 index of the document of each event within the segment
+#   ids.npy               id of each document
+#   processing_times.npy  int64 PRE_PROCESSING -> PIPELINE_FINISHED time of each document
+#   filenames.npy         the files that went into the segment
+# manifest.json lists the segments in order and the state dictionary shared by all of them.
+def load_manifest(store):
+    try:
+        with open(os.path.join(store, 'manifest.json')) as manifest_file:
+            return json.load(manifest_file)
+    except FileNotFoundError:
+        return {"states": [], "segments": []}
+
+
+def save_manifest(store, manifest):
+    path = os.path.join(store, 'manifest.json')
+    with open(path + '.tmp', 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+    os.replace(path + '.tmp', path)
+
+
+# Append the files of the directory that are not in the store yet as a new segment. Files already compacted are
+# not looked at again, even if they changed since.
+def compact_directory(directory, store, decoder, workers=1):
+    os.makedirs(store, exist_ok=True)
+    manifest = load_manifest(store)
+    compacted = set()
+    for segment in manifest["segments"]:
+        compacted.update(np.load(os.path.join(store, segment["name"], 'filenames.npy')).tolist())
+
+    if is_archive(directory):
+        # The members of an archive are compacted under their names inside it
+        records = [(name, record) for name, record in archive_records(directory, decoder) if name not in compacted]
+    else:
+        filenames = [filename for filename in list_json_files(directory) if filename not in compacted]
+        records = parse_batch(directory, filenames, decoder, workers)
+    logging.info('Compacting %d new files into %s', len(records), store)
+    state_codes = {state: code for code, state in enumerate(manifest["states"])}
+    timestamps, states, documents, ids, processing_times, compacted_files = [], [], [], [], [], []
+    for filename, record in records:
+        if record is None:
+            continue
+        id, stats = record
+        for state, timestamp in stats:
+            if state not in state_codes:
+                state_codes[state] = len(manifest["states"])
+                manifest["states"].append(state)
+            timestamps.append(timestamp)
+            states.append(state_codes[state])
+            documents.append(len(ids))
+        ids.append(str(id))
+        processing_times.append(processing_time(stats))
+        compacted_files.append(filename)
+    if not compacted_files:
+        return manifest
+
+    name = 'segment-{:06d}'.format(len(manifest["segments"]))
+    os.makedirs(os.path.join(store, name), exist_ok=True)
+    columns = {'timestamps': np.array(timestamps, dtype=np.int64),
+               'states': np.array(states, dtype=np.int16),
+               'documents': np.array(documents, dtype=np.int32),
+               'ids': np.array(ids, dtype=str),
+               'processing_times': np.array(processing_times, dtype=np.int64),
+               'filenames': np.array(compacted_files, dtype=str)}
+    for column, values in columns.items():
+        np.save(os.path.join(store, name, column + '.npy'), values)
+    # The manifest is written last, so a segment only counts once all its columns are on disk
+    manifest["segments"].append({"name": name, "documents": len(ids), "events": len(timestamps)})
+    save_manifest(store, manifest)
+    return manifest
+
+
+# Memory-map the columns of every segment and join them, turning the per-segment document index into a global one
+def load_store(store):
+    manifest = load_manifest(store)
+    columns = {'timestamps': [], 'states': [], 'documents': [], 'ids': [], 'processing_times': []}
+    offset = 0
+    for segment in manifest["segments"]:
+        for column in columns:
+            values = np.load(os.path.join(store, segment["name"], column + '.npy'), mmap_mode='r')
+            columns[column].append(values + offset if column == 'documents' else values)
+        offset += segment["documents"]
+    if not manifest["segments"]:
+        return manifest["states"], np.array([], dtype=np.int64), np.array([], dtype=np.int16), \
+            np.array([], dtype=np.int32), np.array([], dtype=str), np.array([], dtype=np.int64)
+    return (manifest["states"], *(values[0] if len(values) == 1 else np.concatenate(values)
+                                   for values in columns.values()))
+
+
+# Runtime statistics of one pipeline step, keeping every runtime in a compact int64 array (--exact). Once a runtime
+# is not an integer, e.g. from float utcTimeStamps, the array holds float64 instead.
+class ExactStats:
+    def __init__(self):
+        self.runtimes = array.array('q')
+
+    def __len__(self):
+        return len(self.runtimes)
+
+    def add(self, runtime):
+        try:
+            self.runtimes.append(runtime)
+        except TypeError:
+            self.runtimes = array.array('d', self.runtimes)
+            self.runtimes.append(runtime)
+
+    # Add the runtimes of a partial ExactStats that follow the ones already added
+    def merge(self, other):
+        if other.runtimes.typecode != self.runtimes.typecode:
+            self.runtimes = array.array('d', self.runtimes)
+            self.runtimes.extend(array.array('d', other.runtimes))
+        else:
+            self.runtimes.extend(other.runtimes)
+
+    # (min, max, mean, 10%, 50%, 90%)
+    def summary(self):
+        dtype = np.int64 if self.runtimes.typecode == 'q' else np.float64
+        return ArrayStats(np.frombuffer(self.runtimes, dtype=dtype)).summary()
+
+
+# Runtime statistics of one pipeline step in constant memory: min, max and mean are exact and the percentiles
+# come from a QuantileSketch
+class SketchStats:
+    def __init__(self, error=0.01):
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+        self.sketch = QuantileSketch(error)
+
+    def __len__(self):
+        return self.count
+
+    def add(self, runtime):
+        self.count += 1
+        self.total += runtime
+        self.min = runtime if self.min is None else min(self.min, runtime)
+        self.max = runtime if self.max is None else max(self.max, runtime)
+        self.sketch.add(runtime)
+
+    def extend(self, runtimes):
+        if not runtimes:
+            return
+        self.count += len(runtimes)
+        self.total += sum(runtimes)
+        self.min = min(runtimes) if self.min is None else min(self.min, min(runtimes))
+        self.max = max(runtimes) if self.max is None else max(self.max, max(runtimes))
+        self.sketch.extend(runtimes)
+
+    # Add the runtimes summarized by another SketchStats with the same error
+    def merge(self, other):
+        if not other.count:
+            return
+        self.count += other.count
+        self.total += other.total
+        self.min = other.min if self.min is None else min(self.min, other.min)
+        self.max = other.max if self.max is None else max(self.max, other.max)
+        self.sketch.merge(other.sketch)
+
+    # (min, max, mean, 10%, 50%, 90%)
+    def summary(self):
+        return (self.min, self.max, self.total / self.count,
+                self.sketch.quantile(0.1), self.sketch.quantile(0.5), self.sketch.quantile(0.9))
+
+
+# Runtime statistics of one pipeline step over a NumPy array of runtimes, as read from a columnar store. Gives the
+# same numbers as ExactStats.
+class ArrayStats:
+    def __init__(self, runtimes):
+        self.runtimes = runtimes
+
+    def __len__(self):
+        return len(self.runtimes)
+
+    # (min, max, mean, 10%, 50%, 90%)
+    def summary(self):
+        runtimes = self.runtimes
+        percentile10, percentile50, percentile90 = np.percentile(runtimes, [10, 50, 90])
+        if runtimes.dtype.kind == 'f':
+            return float(runtimes.min()), float(runtimes.max()), float(runtimes.mean()), \
+                percentile10, percentile50, percentile90
+        total, count = int(runtimes.sum()), len(runtimes)
+        # statistics.mean of integers gives an int when the division is exact
+        mean_runtime = total // count if total % count == 0 else total / count
+        return int(runtimes.min()), int(runtimes.max()), mean_runtime, percentile10, percentile50, percentile90
+
+
+# Keeps the k slowest (or fastest) ids of a stream in a bounded heap: O(log k) per value and O(k) memory.
+# Ties keep the id that came first, like a stable sort of the whole stream would.
+class TopK:
+    def __init__(self, k, option):
+        self.k = k
+        self.sign = 1 if option == "slowest" else -1
+        # Min-heap of (signed value, -arrival, id), the root is the entry to evict next
+        self.heap = []
+        self.arrivals = 0
+
+    def add(self, value, id):
+        self.arrivals += 1
+        entry = (self.sign * value, -self.arrivals, id)
+        if len(self.heap) < self.k:
+            heapq.heappush(self.heap, entry)
+        elif entry > self.heap[0]:
+            heapq.heapreplace(self.heap, entry)
+
+    # Add a batch of values and their ids, in arrival order, keeping the same entries as adding them one by one
+    def extend(self, values, ids):
+        entries = [(self.sign * value, -(self.arrivals + position), id)
+                   for position, (value, id) in enumerate(zip(values, ids), 1)]
+        self.arrivals += len(entries)
+        self.heap = heapq.nlargest(self.k, self.heap + entries)
+        heapq.heapify(self.heap)
+
+    # Add the entries of a partial TopK that was built over the values following the ones already added
+    def merge(self, other):
+        for value, _, id in sorted(other.heap, key=lambda entry: -entry[1]):
+            self.add(self.sign * value, id)
+
+    # TopK of whole arrays of values and ids at once, as if they had been added one by one
+    @classmethod
+    def from_values(cls, values, ids, k, option):
+        top = cls(k, option)
+        signed = values if option == "slowest" else -values
+        # A stable sort keeps the first arrival on ties
+        for index in np.argsort(-signed, kind='stable')[:k]:
+            top.heap.append((int(signed[index]), -(int(index) + 1), str(ids[index])))
+        heapq.heapify(top.heap)
+        top.arrivals = len(values)
+        return top
+
+    # (id, value) pairs, slowest (or fastest) first
+    def items(self):
+        return [(id, self.sign * value) for value, _, id in sorted(self.heap, reverse=True)]
+
+
+# Number of ids given with -k, at least 1
+def parse_top(value):
+    try:
+        k = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected a whole number: {}".format(value))
+    if k < 1:
+        raise argparse.ArgumentTypeError("the number of IDs must be at least 1: {}".format(value))
+    return k
+
+
+# Computes the runtime of each transition of the state graph (see pipelines.py) inside each document, as the time
+# between the first timestamps of its two states. Documents that lack a state of the graph are counted as incomplete
+# and only give the runtimes of the transitions whose states they have.
+class Transitions:
+    def __init__(self, pipelines):
+        self.pipelines = pipelines
+        self.steps = [v1 + ' -> ' + v2 for v1, v2 in pipelines]
+        self.states = set(pipeline_states(pipelines))
+
+    # The first timestamp of each state of the graph in one document
+    def first_timestamps(self, stats):
+        first = {}
+        for state, timestamp in stats:
+            if state in self.states and state not in first:
+                first[state] = timestamp
+        return first
+
+    # (step index, runtime) pairs of one document, and whether it has every state of the graph
+    def runtimes(self, stats):
+        first = self.first_timestamps(stats)
+        runtimes = [(step, first[v2] - first[v1]) for step, (v1, v2) in enumerate(self.pipelines)
+                    if v1 in first and v2 in first]
+        return runtimes, len(first) == len(self.states)
+
+
+# Print the top k ids and their time, or note that there are fewer than k of them
+def print_top(top, label):
+    items = top.items()
+    for id, time in items:
+        print(f'{"ID"}:{id}, {label}:{time}')
+    if len(items) < top.k:
+        print("IndexError: list index out of range")
+
+
+# Runtime statistics and top k ids for each transition of the state graph, and the top k ids by total processing
+# time. Updated one document at a time, so it can be printed or queried at any point of a run.
+class Aggregate:
+    def __init__(self, option, exact=False, error=0.01, k=5, pipelines=pipelinesMap):
+        self.option = option
+        self.k = k
+        self.exact = exact
+        self.error = error
+        self.transitions = Transitions(pipelines)
+        # Statistics and top k ids for each pipeline step, "PREVIOUS -> CURRENT", in graph order
+        self.steps = {pipeline_step: ExactStats() if exact else SketchStats(error)
+                      for pipeline_step in self.transitions.steps}
+        self.top = {pipeline_step: TopK(k, option) for pipeline_step in self.transitions.steps}
+        self.step_stats = list(self.steps.values())
+        self.step_top = list(self.top.values())
+        self.top_times = TopK(k, option)
+        self.documents = 0
+        # Documents lacking at least one state of the graph
+        self.incomplete = 0
+
+    # Add the record of one document
+    def add_record(self, id, stats):
+        self.documents += 1
+        self.top_times.add(processing_time(stats), id)
+        runtimes, complete = self.transitions.runtimes(stats)
+        if not complete:
+            self.incomplete += 1
+        for step, runtime in runtimes:
+            self.step_stats[step].add(runtime)
+            self.step_top[step].add(runtime, id)
+
+    # An empty aggregate with the same settings, to be filled by a worker process and merged back with add_partial. In
+    # sketch mode a worker only sends back its sketches, so memory stays constant and the merge in the parent is cheap.
+    def partial(self):
+        return Aggregate(self.option, self.exact, self.error, self.k, self.transitions.pipelines)
+
+    # Add the partial aggregate of the slice of the listing that follows the documents already added
+    def add_partial(self, partial):
+        for step_stats, partial_stats in zip(self.step_stats, partial.step_stats):
+            step_stats.merge(partial_stats)
+        for top, partial_top in zip(self.step_top, partial.step_top):
+            top.merge(partial_top)
+        self.documents += partial.documents
+        self.incomplete += partial.incomplete
+        self.top_times.merge(partial.top_times)
+
+    # Aggregate reporting the given option from merged RollupCells, the document cell first and then one cell per step
+    # of the graph, as kept by the rollup index and the partial aggregate files
+    @classmethod
+    def from_cells(cls, cells, option, error, k, pipelines):
+        aggregate = cls(option, False, error, k, pipelines)
+        documents = cells[DOCUMENTS]
+        aggregate.documents = documents.stats.count
+        aggregate.incomplete = documents.incomplete
+        aggregate.top_times = documents.slowest if option == "slowest" else documents.fastest
+        for pipeline_step, cell in zip(aggregate.transitions.steps, cells[1:]):
+            aggregate.steps[pipeline_step] = cell.stats
+            aggregate.top[pipeline_step] = cell.slowest if option == "slowest" else cell.fastest
+        aggregate.step_stats = list(aggregate.steps.values())
+        aggregate.step_top = list(aggregate.top.values())
+        return aggregate
+
+    # Compute the statistics with vectorized NumPy from the columns of a store (see load_store): the first timestamp
+    # of every state of the graph in every document, then the runtimes of each transition in one subtraction
+    def load_columns(self, state_names, timestamps, states, documents, ids, processing_times):
+        self.documents = len(ids)
+        self.top_times = TopK.from_values(processing_times, ids, self.k, self.option)
+
+        graph_states = pipeline_states(self.transitions.pipelines)
+        graph_index = {state: index for index, state in enumerate(graph_states)}
+        # Index in the graph of each state code of the store, -1 for the states that are not in the graph
+        code_index = np.array([graph_index.get(state, -1) for state in state_names] or [-1], dtype=np.int64)
+        event_index = code_index[states]
+        in_graph = event_index >= 0
+        # The events of a document are stored together and in order, so np.unique's first index of each
+        # (document, state) key is the first timestamp of that state in the document
+        keys = documents[in_graph].astype(np.int64) * len(graph_states) + event_index[in_graph]
+        keys, first = np.unique(keys, return_index=True)
+        first_timestamps = np.zeros((len(ids), len(graph_states)), dtype=np.int64)
+        present = np.zeros((len(ids), len(graph_states)), dtype=bool)
+        first_timestamps.flat[keys] = timestamps[in_graph][first]
+        present.flat[keys] = True
+        self.incomplete = int((~present.all(axis=1)).sum()) if len(ids) else 0
+
+        for step, (v1, v2) in enumerate(self.transitions.pipelines):
+            pipeline_step = self.transitions.steps[step]
+            a, b = graph_index[v1], graph_index[v2]
+            both = present[:, a] & present[:, b]
+            runtimes = first_timestamps[both, b] - first_timestamps[both, a]
+            self.steps[pipeline_step] = ArrayStats(runtimes)
+            self.top[pipeline_step] = TopK.from_values(runtimes, ids[both], self.k, self.option)
+        self.step_stats = list(self.steps.values())
+        self.step_top = list(self.top.values())
+
+    # Answer a query from the watch socket: "stats", "top" or "status"
+    def query(self, command):
+        if command == "stats":
+            return {pipeline_step: dict(zip(["min", "max", "mean", "percentile10", "percentile50", "percentile90"], summary))
+                    for pipeline_step, summary in self.summaries().items()}
+        if command == "top":
+            return {"option": self.option,
+                    "steps": {pipeline_step: top.items() for pipeline_step, top in self.top.items()},
+                    "processing_time": self.top_times.items()}
+        if command == "status":
+            return {"documents": self.documents, "incomplete": self.incomplete,
+                    "steps": sum(1 for step_stats in self.step_stats if len(step_stats))}
+        return {"error": "unknown command: {}".format(command)}
+
+    # Calculate the statistics for each pipeline step that has runtimes: (min, max, mean, 10%, 50%, 90%)
+    def summaries(self):
+        return {pipeline_step: step_stats.summary() for pipeline_step, step_stats in self.steps.items() if len(step_stats)}
+
+    def print_report(self, summaries=None):
+        if summaries is None:
+            summaries = self.summaries()
+        print(
+            "Task 1:\nProcess all files and present a statistic about the runtimes per pipeline step (min, max, 10%/50%/90% percentile and mean).\n")
+        for pipeline_step, summary in summaries.items():
+            min_runtime, max_runtime, mean_runtime, percentile10, percentile50, percentile90 = summary
+            print(f'{pipeline_step} : {min_runtime}s {max_runtime}s {mean_runtime}s {percentile10}s {percentile50}s {percentile90}s')
+        print("\nIncomplete documents (missing a state of the pipeline graph): {} of {}".format(self.incomplete, self.documents))
+
+        #Task2a
+        print("\nTask 2a:\nShow the top {} {} IDs per processing step:".format(self.k, self.option))
+        for pipeline_step, top in self.top.items():
+            if not len(self.steps[pipeline_step]):
+                continue
+            print(pipeline_step)
+            print_top(top, "TIME")
+
+        #Task2
+        print("\nTask 2:\nShow the top {} {} IDs & total processing time between the states:".format(self.k, self.option))
+        print_top(self.top_times, "PROCESSING_TIME")
         # print("UTC timestamp: ", datetime.utcfromtimestamp(time / 1000).strftime('%Y-%m-%d %H:%M:%S'))
-        # print("\n")
 
-if __name__ == '__main__':
+
+# Add the given files of the directory to the aggregate, in listing order
+def load_files(aggregate, directory, filenames, decoder, workers=1, cache_path=None):
+    if cache_path:
+        for filename, record in cached_records(directory, filenames, cache_path, decoder, workers):
+            if record is not None:
+                aggregate.add_record(*record)
+    elif workers > 1 and len(filenames) > 1:
+        # executor.map returns results in submission order, so the partials are consumed in listing order and give
+        # exactly what a single pass would produce
+        chunks = split_files(filenames, workers)
+        with worker_pool(workers) as executor:
+            partials = executor.map(process_files, [directory] * len(chunks), chunks,
+                                    [aggregate.partial() for _ in chunks], [decoder.fresh() for _ in chunks])
+            for partial, partial_decoder in partials:
+                aggregate.add_partial(partial)
+                decoder.add_counters(partial_decoder)
+    else:
+        for id, stats in iter_records(directory, filenames, decoder):
+            aggregate.add_record(id, stats)
+
+
+# Rollup index. The runtimes of each pipeline step are summarized per minute, hour and day of the utcTimeStamp (in ms)
+# of the state ending the step, and the documents per bucket of their last timestamp. Every cell holds mergeable
+# statistics (count, sum, min, max and a quantile sketch) and the top k slowest and fastest ids, so a time range is
+# answered by merging the few day, hour and minute cells that cover it. The index is an SQLite file with one row per
+# cell, so a query only reads the cells of its range, and adding files only rewrites the cells of their buckets. Cells
+# are stored as compact JSON of their plain values (see RollupCell.state), like the partial aggregate files, so reading
+# an index never unpickles anything.
+# Steps are stored by their position in the state graph, from 1, and the document cells have step 0. Documents
+# without any stats entry have no timestamp to be bucketed by; they are counted in the one document cell of the
+# UNDATED bucket, which only queries over the whole index read.
+BUCKETS = {"minute": 60 * 1000, "hour": 3600 * 1000, "day": 24 * 3600 * 1000}
+UNDATED = "undated"
+DOCUMENTS = 0
+INDEX_FORMAT = "jsonproc-index-2"
+
+
+class RollupCell:
+    __slots__ = ("stats", "slowest", "fastest", "incomplete")
+
+    def __init__(self, error, k):
+        self.stats = SketchStats(error)
+        self.slowest = TopK(k, "slowest")
+        self.fastest = TopK(k, "fastest")
+        # Documents of the bucket that lack a state of the graph, only counted in the document cells
+        self.incomplete = 0
+
+    # The cell as a tuple of plain values, one row of the index. Plain values encode several times smaller and faster
+    # than the objects, which matters with a row per step and minute. A cell of k values or fewer is kept as just its
+    # values and ids in arrival order, which give back the same sketch and heaps.
+    def state(self):
+        stats = self.stats
+        if stats.count <= self.slowest.k:
+            entries = sorted(self.slowest.heap, key=lambda entry: -entry[1])
+            return [value for value, _, _ in entries], [id for _, _, id in entries], self.incomplete
+        return (stats.count, stats.total, stats.min, stats.max, stats.sketch.compactors,
+                self.slowest.heap, self.fastest.heap, self.slowest.arrivals, self.incomplete)
+
+    @classmethod
+    def from_state(cls, state, error, k):
+        cell = cls(error, k)
+        if len(state) == 3:
+            values, ids, cell.incomplete = state
+            cell.extend(values, ids)
+            return cell
+        stats = cell.stats
+        stats.count, stats.total, stats.min, stats.max, compactors, slowest, fastest, arrivals, cell.incomplete = state
+        stats.sketch.restore(compactors)
+        # Heap entries are compared with the new ones, so they must be tuples again when the state was read from JSON
+        cell.slowest.heap = [tuple(entry) for entry in slowest]
+        cell.fastest.heap = [tuple(entry) for entry in fastest]
+        cell.slowest.arrivals = cell.fastest.arrivals = arrivals
+        return cell
+
+    def extend(self, values, ids):
+        self.stats.extend(values)
+        self.slowest.extend(values, ids)
+        self.fastest.extend(values, ids)
+
+    # Add a cell covering later documents of the same bucket
+    def merge(self, other):
+        self.stats.merge(other.stats)
+        self.slowest.merge(other.slowest)
+        self.fastest.merge(other.fastest)
+        self.incomplete += other.incomplete
+
+
+class RollupIndex:
+    # error None opens the index with the error it was built with, 0.01 for a new one
+    def __init__(self, index_path, pipelines=pipelinesMap, error=None, k=5):
+        self.connection = sqlite3.connect(index_path)
+        self.connection.executescript('''
+            CREATE TABLE IF NOT EXISTS settings (name TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER);
+            CREATE TABLE IF NOT EXISTS cells (bucket TEXT, start INTEGER, step INTEGER, cell TEXT,
+                                              PRIMARY KEY (bucket, start, step)) WITHOUT ROWID;''')
+        settings = dict(self.connection.execute("SELECT name, value FROM settings"))
+        if not settings:
+            settings = {"format": INDEX_FORMAT, "pipelines": json.dumps(pipelines), "error": repr(0.01 if error is None else error),
+                        "k": str(k)}
+            with self.connection:
+                self.connection.executemany("INSERT INTO settings VALUES (?, ?)", settings.items())
+        if settings.get("format") != INDEX_FORMAT:
+            raise ValueError("The index {} was written by an earlier version, delete it to rebuild it".format(index_path))
+        # The index keeps the graph, sketch error and k it was built with
+        if [tuple(pipeline) for pipeline in json.loads(settings["pipelines"])] != list(pipelines):
+            raise ValueError("The index {} was built with another state graph".format(index_path))
+        self.error = float(settings["error"])
+        if error is not None and error != self.error:
+            raise ValueError("The index {} was built with --error {}, rebuild it for --error {}".format(
+                index_path, self.error, error))
+        self.k = int(settings["k"])
+        if k > self.k:
+            raise ValueError("The index {} keeps the top {} ids, rebuild it for -k {}".format(index_path, self.k, k))
+        self.transitions = Transitions(pipelines)
+        # Number of values a new sketch holds before its first compaction
+        self.sketch_size = QuantileSketch(self.error).max_size
+
+    def close(self):
+        self.connection.close()
+
+    # Absolute path of every file already in the index, with its (size, mtime) when it was added
+    def files(self):
+        return {path: (size, mtime) for path, size, mtime in self.connection.execute("SELECT path, size, mtime FROM files")}
+
+    # Add the records of new files, given as (path, (size, mtime), (id, stats)), in one transaction
+    def add_records(self, records):
+        # The batch makes a few small lists per cell
+        with gc_paused():
+            self.add_batch(records)
+
+    def add_batch(self, records):
+        # One event per runtime of the batch: the timestamp it is bucketed by, the step, the runtime and the document,
+        # in arrival order
+        timestamps, steps, values, documents = [], [], [], []
+        ids = []
+        incomplete_timestamps = []
+        undated_ids = []
+        for _, _, (id, stats) in records:
+            if not stats:
+                undated_ids.append(id)
+                continue
+            first = self.transitions.first_timestamps(stats)
+            document = len(ids)
+            ids.append(id)
+            for step, (v1, v2) in enumerate(self.transitions.pipelines, 1):
+                if v1 in first and v2 in first:
+                    timestamps.append(first[v2])
+                    steps.append(step)
+                    values.append(first[v2] - first[v1])
+                    documents.append(document)
+            last_timestamp = max(timestamp for _, timestamp in stats)
+            timestamps.append(last_timestamp)
+            steps.append(DOCUMENTS)
+            values.append(processing_time(stats))
+            documents.append(document)
+            if len(first) < len(self.transitions.states):
+                incomplete_timestamps.append(last_timestamp)
+        timestamps = np.array(timestamps, dtype=np.int64)
+        steps = np.array(steps, dtype=np.int64)
+        values = np.array(values, dtype=np.int64)
+        documents = np.array(documents, dtype=np.int64)
+        incomplete_timestamps = np.array(incomplete_timestamps, dtype=np.int64)
+
+        # State of each (bucket, start, step) cell of the batch. A stable sort groups the events by cell and keeps
+        # them in arrival order within each one.
+        states = {}
+        for bucket, width in BUCKETS.items():
+            starts = timestamps - timestamps % width
+            order = np.lexsort((steps, starts))
+            cell_starts, cell_steps = starts[order], steps[order]
+            boundaries = np.flatnonzero((np.diff(cell_starts) != 0) | (np.diff(cell_steps) != 0)) + 1
+            bounds = [0] + boundaries.tolist() + [len(order)]
+            cell_starts, cell_steps = cell_starts.tolist(), cell_steps.tolist()
+            cell_values = values[order].tolist()
+            cell_ids = [ids[document] for document in documents[order].tolist()]
+            incomplete_starts, incomplete_counts = np.unique(incomplete_timestamps - incomplete_timestamps % width,
+                                                             return_counts=True)
+            incomplete = dict(zip(incomplete_starts.tolist(), incomplete_counts.tolist()))
+            for a, b in zip(bounds, bounds[1:]):
+                if a == b:
+                    continue
+                step = cell_steps[a]
+                states[(bucket, cell_starts[a], step)] = self.cell_state(
+                    cell_values[a:b], cell_ids[a:b], incomplete.get(cell_starts[a], 0) if step == DOCUMENTS else 0)
+
+        if undated_ids:
+            # Their processing time is 0 and they lack every state of the graph
+            states[(UNDATED, 0, DOCUMENTS)] = self.cell_state([0] * len(undated_ids), undated_ids,
+                                                              len(undated_ids) if self.transitions.states else 0)
+
+        # The cells already in the index for the buckets of the batch come first, the batch is merged into them
+        for bucket in list(BUCKETS) + [UNDATED]:
+            starts = [start for cell_bucket, start, _ in states if cell_bucket == bucket]
+            if not starts:
+                continue
+            rows = self.connection.execute("SELECT start, step, cell FROM cells WHERE bucket = ? AND start BETWEEN ? AND ?",
+                                           (bucket, min(starts), max(starts)))
+            for start, step, text in rows:
+                key = (bucket, start, step)
+                if key in states:
+                    cell = RollupCell.from_state(json.loads(text), self.error, self.k)
+                    cell.merge(RollupCell.from_state(states[key], self.error, self.k))
+                    states[key] = cell.state()
+
+        with self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO cells VALUES (?, ?, ?, ?)",
+                                        ((bucket, start, step, json.dumps(state, separators=(',', ':')))
+                                         for (bucket, start, step), state in states.items()))
+            self.connection.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?)",
+                                        ((path, size, mtime) for path, (size, mtime), _ in records))
+
+    # The state of a new cell holding the given values and ids in arrival order (see RollupCell.state), without building
+    # the objects: the values fit in the first compactor of the sketch unless there are more than it holds, and the
+    # heaps keep the same (signed value, -arrival, id) entries TopK does. Most minute cells only hold a value or two.
+    def cell_state(self, values, ids, incomplete=0):
+        if len(values) <= self.k:
+            return values, ids, incomplete
+        if len(values) < self.sketch_size:
+            compactors = [values]
+        else:
+            sketch = QuantileSketch(self.error)
+            sketch.extend(values)
+            compactors = sketch.compactors
+        arrivals = range(-1, -len(values) - 1, -1)
+        slowest = heapq.nlargest(self.k, zip(values, arrivals, ids))
+        fastest = heapq.nlargest(self.k, zip([-value for value in values], arrivals, ids))
+        heapq.heapify(slowest)
+        heapq.heapify(fastest)
+        return len(values), sum(values), min(values), max(values), compactors, slowest, fastest, len(values), incomplete
+
+    # First and last minute with data, the default range of a query
+    def extent(self):
+        return self.connection.execute("SELECT MIN(start), MAX(start) FROM cells WHERE bucket = 'minute'").fetchone()
+
+    # The fewest (bucket, start) cells covering [start, end), both on minute boundaries: whole days, then whole hours,
+    # then minutes at the edges
+    @staticmethod
+    def cover(start, end):
+        keys = []
+        while start < end:
+            for bucket in ("day", "hour", "minute"):
+                width = BUCKETS[bucket]
+                if start % width == 0 and start + width <= end:
+                    keys.append((bucket, start))
+                    start += width
+                    break
+        return keys
+
+    # Aggregate of the documents and runtimes between start and end (ms, end excluded), rounded out to whole minutes.
+    # Without a start and an end it covers the whole index, undated documents included.
+    def query(self, option, k=None, start=None, end=None):
+        k = self.k if k is None else k
+        rows = []
+        if start is None and end is None:
+            rows.extend(self.connection.execute("SELECT start, step, cell FROM cells WHERE bucket = ?", (UNDATED,)))
+        minute = BUCKETS["minute"]
+        first, last = self.extent()
+        start = first if start is None else start - start % minute
+        end = (last or 0) + minute if end is None else -(-end // minute) * minute
+        keys = self.cover(start, end) if start is not None else []
+
+        for bucket in BUCKETS:
+            starts = [key_start for key_bucket, key_start in keys if key_bucket == bucket]
+            # In chunks below SQLite's limit on the number of parameters
+            for chunk in range(0, len(starts), 500):
+                chunk_starts = starts[chunk:chunk + 500]
+                rows.extend(self.connection.execute("SELECT start, step, cell FROM cells WHERE bucket = ? AND start IN ({})"
+                                                    .format(", ".join("?" * len(chunk_starts))), [bucket] + chunk_starts))
+        # Merged in time order, so the top k keep the earliest ids on ties like a scan of the files would
+        merged = [RollupCell(self.error, k) for _ in range(len(self.transitions.steps) + 1)]
+        for _, step, text in sorted(rows, key=lambda row: row[0]):
+            merged[step].merge(RollupCell.from_state(json.loads(text), self.error, self.k))
+        return Aggregate.from_cells(merged, option, self.error, k, self.transitions.pipelines)
+
+    # Split [start, end) into (start, end) ranges on the boundaries of the given bucket, e.g. one per hour
+    def ranges(self, bucket, start=None, end=None):
+        first, last = self.extent()
+        if first is None:
+            return []
+        width = BUCKETS[bucket]
+        start = first if start is None else start
+        end = last + BUCKETS["minute"] if end is None else end
+        return [(max(bucket_start, start), min(bucket_start + width, end))
+                for bucket_start in range(start - start % width, end, width)]
+
+
+# Add the files of the directory (or the members of an archive) that are not in the index yet. Files that changed
+# since they were added are left as they are, since their old runtimes cannot be taken out of the cells.
+def update_index(index, directory, decoder, workers=1):
+    indexed = index.files()
+    if is_archive(directory):
+        prefix = os.path.abspath(directory) + '/'
+        records = [(prefix + name, (None, None), record) for name, record in archive_records(directory, decoder)
+                   if prefix + name not in indexed]
+    else:
+        absolute_directory = os.path.abspath(directory)
+        new_files = {}
+        for filename in list_json_files(directory):
+            path = os.path.join(absolute_directory, filename)
+            file_stat = os.stat(path)
+            signature = (file_stat.st_size, file_stat.st_mtime_ns)
+            if path not in indexed:
+                new_files[filename] = signature
+            elif indexed[path] != signature:
+                logging.warning("File changed since it was indexed, delete the index to rebuild it: %s", filename)
+        records = [(os.path.join(absolute_directory, filename), new_files[filename], record) for filename, record
+                   in parse_batch(directory, list(new_files), decoder, workers)]
+    # Files that cannot be parsed are not recorded, so they are tried again on the next run
+    records = [(path, signature, record) for path, signature, record in records if record is not None]
+    logging.info('Files added to the index: %d', len(records))
+    index.add_records(records)
+    return index
+
+
+# Milliseconds since the epoch from a number of milliseconds or an ISO date and time, in UTC unless it has an offset,
+# e.g. 2020-01-15T14:00
+def parse_time(value):
+    if value.isdigit():
+        return int(value)
+    moment = datetime.fromisoformat(value)
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return int(moment.timestamp() * 1000)
+
+
+def format_time(timestamp):
+    return datetime.fromtimestamp(timestamp / 1000, timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
+
+
+# Partial aggregate files of the map and reduce subcommands. A map run summarizes one shard of the files into a
+# ShardAggregate: a RollupCell for the documents (total processing time and incomplete count) and one per step of the
+# graph, each with count, sum, min, max, quantile sketch and both the slowest and fastest k ids. Cells merge like the
+# ones of the rollup index, so reduce combines any number of shards mapped on any hosts and reports either option.
+# The file is gzipped JSON of the plain values of the cells (see RollupCell.state), so shards copied from other hosts
+# are read as data only.
+PARTIAL_FORMAT = "jsonproc-partial-1"
+# Records added to the cells at a time
+PARTIAL_BATCH = 1000
+
+
+# Whether a file (or archive member) belongs to the shard: its name matches the glob pattern, and its CRC32 modulo the
+# number of partitions is the partition index. Unlike hash(), the CRC is the same on every host and run.
+def in_shard(name, pattern=None, partition=None):
+    if pattern is not None and not fnmatch.fnmatchcase(name, pattern):
+        return False
+    if partition is not None:
+        index, count = partition
+        return zlib.crc32(name.encode()) % count == index
+    return True
+
+
+# "I/N", the partition I of N used by map --partition
+def parse_partition(value):
+    try:
+        index, count = (int(part) for part in value.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected INDEX/COUNT, e.g. 0/4: {}".format(value))
+    if not 0 <= index < count:
+        raise argparse.ArgumentTypeError("the index must be between 0 and COUNT - 1: {}".format(value))
+    return index, count
+
+
+class ShardAggregate:
+    def __init__(self, pipelines=pipelinesMap, error=0.01, k=5):
+        self.pipelines = [tuple(pipeline) for pipeline in pipelines]
+        self.error = error
+        self.k = k
+        self.transitions = Transitions(self.pipelines)
+        self.cells = [RollupCell(error, k) for _ in range(len(self.transitions.steps) + 1)]
+
+    # An empty shard with the same settings, to be filled by a worker process
+    def empty(self):
+        return ShardAggregate(self.pipelines, self.error, self.k)
+
+    # Add (id, stats) records in arrival order, a batch of values per cell at a time
+    def add_records(self, records):
+        records = iter(records)
+        while True:
+            batch = list(itertools.islice(records, PARTIAL_BATCH))
+            if not batch:
+                return
+            values = [[] for _ in self.cells]
+            ids = [[] for _ in self.cells]
+            for id, stats in batch:
+                values[DOCUMENTS].append(processing_time(stats))
+                ids[DOCUMENTS].append(id)
+                runtimes, complete = self.transitions.runtimes(stats)
+                if not complete:
+                    self.cells[DOCUMENTS].incomplete += 1
+                for step, runtime in runtimes:
+                    values[step + 1].append(runtime)
+                    ids[step + 1].append(id)
+            for cell, cell_values, cell_ids in zip(self.cells, values, ids):
+                if cell_values:
+                    cell.extend(cell_values, cell_ids)
+
+    # Add a shard built with the same graph and error, covering documents that follow the ones already added
+    def merge(self, other):
+        for cell, other_cell in zip(self.cells, other.cells):
+            cell.merge(other_cell)
+
+    def aggregate(self, option, k=None):
+        return Aggregate.from_cells(self.cells, option, self.error, self.k if k is None else k, self.pipelines)
+
+    def save(self, path):
+        state = {"format": PARTIAL_FORMAT, "pipelines": self.pipelines, "error": self.error, "k": self.k,
+                 "cells": [cell.state() for cell in self.cells]}
+        # Write next to the file and rename it, so a reduce never picks up a half written shard
+        with gzip.open(path + '.tmp', 'wt', encoding='utf-8') as partial_file:
+            json.dump(state, partial_file, separators=(',', ':'))
+        os.replace(path + '.tmp', path)
+
+    # Raises ValueError for a file that is not a complete partial aggregate file, e.g. one truncated by a copy
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as partial_file:
+            try:
+                with gzip.open(partial_file, 'rt', encoding='utf-8') as json_file:
+                    state = json.load(json_file)
+                if state["format"] != PARTIAL_FORMAT or len(state["cells"]) != len(state["pipelines"]) + 1:
+                    raise ValueError
+                shard = cls(state["pipelines"], float(state["error"]), int(state["k"]))
+                shard.cells = [RollupCell.from_state(cell_state, shard.error, shard.k) for cell_state in state["cells"]]
+            except (OSError, EOFError, ValueError, KeyError, TypeError, IndexError):
+                raise ValueError("{} is not a partial aggregate file written by map, or it is damaged".format(path))
+        return shard
+
+
+# Fill the shard with a slice of its files, returned along with the decoder and its counters. Runs inside the worker
+# processes when --workers is used.
+def map_files(directory, filenames, shard, decoder):
+    shard.add_records(iter_records(directory, filenames, decoder))
+    return shard, decoder
+
+
+# Summarize the files of the directory (or the members of an archive) that belong to the shard
+def map_directory(directory, shard, decoder, workers=1, cache_path=None, pattern=None, partition=None):
+    if is_archive(directory):
+        shard.add_records(record for _, record in archive_records(
+            directory, decoder, lambda name: in_shard(name, pattern, partition)) if record is not None)
+        return shard
+    filenames = [filename for filename in list_json_files(directory) if in_shard(filename, pattern, partition)]
+    logging.info('Files in the shard: %d', len(filenames))
+    if cache_path:
+        shard.add_records(record for _, record in cached_records(directory, filenames, cache_path, decoder, workers)
+                          if record is not None)
+    elif workers > 1 and len(filenames) > 1:
+        # Merged back in listing order, like load_files
+        chunks = split_files(filenames, workers)
+        with worker_pool(workers) as executor:
+            for partial, partial_decoder in executor.map(map_files, [directory] * len(chunks), chunks,
+                                                         [shard.empty() for _ in chunks],
+                                                         [decoder.fresh() for _ in chunks]):
+                shard.merge(partial)
+                decoder.add_counters(partial_decoder)
+    else:
+        map_files(directory, filenames, shard, decoder)
+    return shard
+
+
+# Merge the partial aggregate files in the given order into the aggregate of all their documents. The shards must
+# come from the same graph and sketch error, and keep at least the top k ids asked for (the smallest -k of the shards
+# by default).
+def reduce_partials(paths, option, k=None):
+    shards = [ShardAggregate.load(path) for path in paths]
+    first = shards[0]
+    k = min(shard.k for shard in shards) if k is None else k
+    for path, shard in zip(paths, shards):
+        if shard.pipelines != first.pipelines or shard.error != first.error:
+            raise ValueError("{} was mapped with another state graph or --error than {}".format(path, paths[0]))
+        if shard.k < k:
+            raise ValueError("{} keeps the top {} ids, map it again with -k {}".format(path, shard.k, k))
+    total = ShardAggregate(first.pipelines, first.error, k)
+    for shard in shards:
+        total.merge(shard)
+    return total.aggregate(option)
+
+
+# Wall time of each phase of a run, with the throughput, error count and peak memory, as a JSON metrics document
+class Profile:
+    def __init__(self):
+        self.phases = {}
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + time.perf_counter() - started
+
+    def document(self, decoder, aggregate, workers):
+        phases = dict(self.phases)
+        ingest = phases.get("ingest", 0.0)
+        # Read and decode are measured per file, summed over the worker processes when there are several, so the
+        # time left for aggregating only follows from them in a single process
+        phases["read"] = decoder.read_seconds
+        phases["decode"] = decoder.decode_seconds
+        if workers <= 1:
+            phases["aggregate"] = max(0.0, ingest - decoder.read_seconds - decoder.decode_seconds)
+        # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+        rss_unit = 1 if sys.platform == 'darwin' else 1024
+        return {"phases": {name: round(seconds, 6) for name, seconds in phases.items()},
+                "workers": workers,
+                "decoder": decoder.name,
+                # Files read, the malformed ones included; documents are the ones that parsed
+                "files": decoder.files,
+                "bytes": decoder.bytes,
+                "errors": decoder.errors,
+                "documents": aggregate.documents,
+                "files_per_second": decoder.files / ingest if ingest else None,
+                "bytes_per_second": decoder.bytes / ingest if ingest else None,
+                "peak_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * rss_unit,
+                "peak_rss_workers_bytes": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * rss_unit}
+
+    # Write the document to the given file, or print it when the path is "-"
+    def write(self, path, decoder, aggregate, workers):
+        document = json.dumps(self.document(decoder, aggregate, workers), indent=2)
+        if path == "-":
+            print(document)
+        else:
+            with open(path, 'w') as profile_file:
+                profile_file.write(document + '\n')
+
+
+def process_directory(directory, option, workers=1, exact=False, error=0.01, k=5, cache_path=None, decoder_name="auto",
+                      store=None, profile_path=None, read_ahead=0, read_ahead_memory=READ_AHEAD_MEMORY,
+                      pipelines=pipelinesMap, index_path=None, start=None, end=None, bucket=None):
+    # error None queries an index with the error it was built with
+    aggregate = Aggregate(option, exact, 0.01 if error is None else error, k, pipelines)
+    decoder = Decoder(decoder_name, read_ahead, read_ahead_memory)
+    profile = Profile()
+    bucket_aggregates = None
+
+    logging.info('Start processing directory: %s', directory)
+    if index_path:
+        # Add the new files to the rollup index, then answer the time range from its cells alone. Without a directory
+        # the index is only queried.
+        with profile.phase("ingest"):
+            index = RollupIndex(index_path, pipelines, error, k)
+            if directory:
+                update_index(index, directory, decoder, workers)
+        with profile.phase("query"):
+            if bucket:
+                # Only the buckets are printed, so the range as a whole is not queried. The profile counts the
+                # documents of the buckets.
+                bucket_aggregates = [(range_start, range_end, index.query(option, k, range_start, range_end))
+                                     for range_start, range_end in index.ranges(bucket, start, end)]
+                aggregate.documents = sum(bucket_aggregate.documents for _, _, bucket_aggregate in bucket_aggregates)
+            else:
+                aggregate = index.query(option, k, start, end)
+            index.close()
+    elif store:
+        # Append the new files to the store, then report from the store alone. Without a directory the store is only
+        # read.
+        if directory:
+            with profile.phase("ingest"):
+                compact_directory(directory, store, decoder, workers)
+        with profile.phase("load"):
+            aggregate.load_columns(*load_store(store))
+    elif is_archive(directory):
+        # Stream the documents of the archive straight into the aggregate
+        with profile.phase("ingest"):
+            for name, record in archive_records(directory, decoder):
+                if record is not None:
+                    aggregate.add_record(*record)
+    else:
+        # Get a list of all the JSON files in the directory
+        with profile.phase("listing"):
+            filenames = list_json_files(directory)
+        with profile.phase("ingest"):
+            load_files(aggregate, directory, filenames, decoder, workers, cache_path)
+    if bucket_aggregates is not None:
+        # One report per bucket that has documents or runtimes
+        with profile.phase("report"):
+            for range_start, range_end, bucket_aggregate in bucket_aggregates:
+                if bucket_aggregate.documents or any(len(step_stats) for step_stats in bucket_aggregate.step_stats):
+                    print("{} - {}\n".format(format_time(range_start), format_time(range_end)))
+                    bucket_aggregate.print_report()
+                    print()
+    else:
+        with profile.phase("stats"):
+            summaries = aggregate.summaries()
+        with profile.phase("report"):
+            aggregate.print_report(summaries)
+        print()
+    decoder.print_throughput()
+    if profile_path:
+        profile.write(profile_path, decoder, aggregate, workers)
+
+
+# Serves queries on the watch socket, one command per line, answering each with one line of JSON
+class QueryHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            command = line.decode().strip()
+            if not command:
+                continue
+            with self.server.lock:
+                response = self.server.aggregate.query(command)
+            self.wfile.write((json.dumps(response) + '\n').encode())
+
+
+class QueryServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, aggregate, lock):
+        self.aggregate = aggregate
+        self.lock = lock
+        super().__init__(socket_path, QueryHandler)
+
+
+# Whether the path is a Unix domain socket, e.g. one left behind by an earlier watch that was killed
+def is_socket(path):
+    try:
+        return stat.S_ISSOCK(os.lstat(path).st_mode)
+    except FileNotFoundError:
+        return False
+
+
+# Polls after which watch mode lists the directory again even though its mtime did not change. On NFS the attributes
+# are cached and the timestamps can be coarse, so a file landing in the same tick as the last listing does not always
+# change the mtime that is seen.
+WATCH_RELIST_POLLS = 10
+
+
+# mtime of a file in the directory, or None once it has been removed
+def file_mtime(directory, filename):
+    try:
+        return os.stat(os.path.join(directory, filename)).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+# Stay resident and add the .json files as they land in the directory. The directory is polled every `interval`
+# seconds and only listed again when its mtime changes; files that cannot be parsed yet (e.g. still being written)
+# are retried once their own mtime changes. The report is printed again after each batch of new files, and the
+# aggregate can be queried over a Unix domain socket in the meantime.
+def watch_directory(directory, option, workers=1, exact=False, error=0.01, k=5, cache_path=None, decoder_name="auto",
+                    socket_path=None, interval=1.0, read_ahead=0, read_ahead_memory=READ_AHEAD_MEMORY,
+                    pipelines=pipelinesMap):
+    aggregate = Aggregate(option, exact, error, k, pipelines)
+    decoder = Decoder(decoder_name, read_ahead, read_ahead_memory)
+    lock = threading.Lock()
+    seen = set()
+    failed = {}
+
+    server = None
+    if socket_path:
+        # Only a stale socket is replaced, anything else at the path is left alone
+        if is_socket(socket_path):
+            os.unlink(socket_path)
+        elif os.path.lexists(socket_path):
+            raise ValueError("--socket must be a socket or a new path, {} exists".format(socket_path))
+        server = QueryServer(socket_path, aggregate, lock)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    # Shut down cleanly (and remove the socket) when stopped by a service manager as well as with Ctrl-C
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+    # One pool for the life of the watch, so a batch of new files does not start the workers again
+    executor = worker_pool(workers, resident=True) if workers > 1 else None
+
+    logging.info('Start watching directory: %s', directory)
+    directory_mtime = None
+    polls = 0
+    try:
+        while True:
+            retry = set()
+            for filename, mtime in list(failed.items()):
+                current_mtime = file_mtime(directory, filename)
+                if current_mtime is None:
+                    del failed[filename]
+                elif current_mtime != mtime:
+                    retry.add(filename)
+
+            mtime = os.stat(directory).st_mtime_ns
+            polls += 1
+            if mtime != directory_mtime or retry or polls % WATCH_RELIST_POLLS == 0:
+                filenames = [filename for filename in list_json_files(directory) if filename not in seen
+                             and (filename not in failed or filename in retry)]
+                if filenames:
+                    # Parse outside the lock so queries are not held up. The cache only helps the first scan.
+                    if cache_path and directory_mtime is None:
+                        records = list(cached_records(directory, filenames, cache_path, decoder, workers, executor))
+                    else:
+                        records = parse_batch(directory, filenames, decoder, workers, executor)
+                    with lock:
+                        for filename, record in records:
+                            if record is None:
+                                failed[filename] = file_mtime(directory, filename)
+                            else:
+                                aggregate.add_record(*record)
+                                seen.add(filename)
+                                failed.pop(filename, None)
+                    aggregate.print_report()
+                directory_mtime = mtime
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(socket_path)
+
+# python <script.py> compact -d /path/to/directory -s /path/to/store
+def compact_main(argv):
+    parser = argparse.ArgumentParser(prog='compact',
+        description='Append the new json files of a directory to a columnar store.')
+    parser.add_argument("-d", "--directory", help='The directory to compact, or a .tar(.gz), .zip or .ndjson(.gz) file.', required=True)
+    parser.add_argument("-s", "--store", help="the columnar store directory", required=True)
+    parser.add_argument("-w", "--workers", help="number of worker processes used to parse the files", type=int, default=1)
+    parser.add_argument("--decoder", help="JSON backend, orjson when installed by default", choices=["auto"] + list(DECODERS), default="auto")
+    parser.add_argument("--read-ahead", help="number of files read ahead of the parser on a thread pool (default 0, off)", type=parse_read_ahead, default=0)
+    parser.add_argument("--read-ahead-memory", help="cap in MB on the bytes read ahead and not parsed yet (default 64)",
+                        type=parse_read_ahead_memory,
+                        default=READ_AHEAD_MEMORY >> 20)
+    args = parser.parse_args(argv)
+    setup_logging()
+    decoder = Decoder(args.decoder, args.read_ahead, args.read_ahead_memory << 20)
+    manifest = compact_directory(args.directory, args.store, decoder, args.workers)
+    print("Store {}: {} segments, {} documents, {} events".format(
+        args.store, len(manifest["segments"]), sum(segment["documents"] for segment in manifest["segments"]),
+        sum(segment["events"] for segment in manifest["segments"])))
+    decoder.print_throughput()
+
+
+# python <script.py> map -d /path/to/directory -p shard.part [--glob 'a*.json'] [--partition 0/4]
+def map_main(argv):
+    parser = argparse.ArgumentParser(prog='map',
+        description='Summarize a shard of the json files of a directory into a partial aggregate file for reduce.')
+    parser.add_argument("-d", "--directory", help='The directory to map, or a .tar(.gz), .zip or .ndjson(.gz) file.', required=True)
+    parser.add_argument("-p", "--partial", help="the partial aggregate file to write", required=True)
+    parser.add_argument("--glob", help="only map the files whose name matches this pattern, e.g. '2020-01-*.json'")
+    parser.add_argument("--partition", help="only map the files whose name hashes to partition INDEX of COUNT, e.g. 0/4",
+                        type=parse_partition)
+    parser.add_argument("-k", help="number of slowest and fastest IDs to keep (default 5)", type=parse_top, default=5)
+    parser.add_argument("--error", help="rank error bound of the percentile sketch (default 0.01)", type=parse_error, default=0.01)
+    parser.add_argument("--graph", help="JSON file with the [from, to] transitions of the state graph (default pipelines.json)")
+    parser.add_argument("-w", "--workers", help="number of worker processes used to parse the files", type=int, default=1)
+    parser.add_argument("--cache", help="directory caching the parsed records between runs, e.g. .jsonproc-cache")
+    parser.add_argument("--decoder", help="JSON backend, orjson when installed by default", choices=["auto"] + list(DECODERS), default="auto")
+    parser.add_argument("--read-ahead", help="number of files read ahead of the parser on a thread pool (default 0, off)", type=parse_read_ahead, default=0)
+    parser.add_argument("--read-ahead-memory", help="cap in MB on the bytes read ahead and not parsed yet (default 64)",
+                        type=parse_read_ahead_memory,
+                        default=READ_AHEAD_MEMORY >> 20)
+    args = parser.parse_args(argv)
+    if args.cache and os.path.isfile(args.cache):
+        parser.error("--cache must be a directory, {} is a file".format(args.cache))
+    setup_logging()
+    pipelines = load_pipelines(args.graph) if args.graph else pipelinesMap
+    decoder = Decoder(args.decoder, args.read_ahead, args.read_ahead_memory << 20)
+    shard = map_directory(args.directory, ShardAggregate(pipelines, args.error, args.k), decoder, args.workers,
+                          args.cache, args.glob, args.partition)
+    shard.save(args.partial)
+    print("Partial {}: {} documents".format(args.partial, len(shard.cells[DOCUMENTS].stats)))
+    decoder.print_throughput()
+
+
+# python <script.py> reduce -o slowest shard0.part shard1.part ...
+def reduce_main(argv):
+    parser = argparse.ArgumentParser(prog='reduce',
+        description='Merge partial aggregate files written by map and present the statistics of all their documents.')
+    parser.add_argument("partials", help="partial aggregate files", nargs='+')
+    parser.add_argument("-o", "--option", help="sort by slowest or fastest", choices=["slowest", "fastest"], required=True)
+    parser.add_argument("-k", help="number of slowest/fastest IDs to show (default: the -k of map)", type=parse_top)
+    args = parser.parse_args(argv)
+    setup_logging()
+    try:
+        aggregate = reduce_partials(args.partials, args.option, args.k)
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+    aggregate.print_report()
+    print()
+
+
+SUBCOMMANDS = {'compact': compact_main, 'map': map_main, 'reduce': reduce_main}
+
+if __name__ == '__main__' and sys.argv[1:2] and sys.argv[1] in SUBCOMMANDS:
+    SUBCOMMANDS[sys.argv[1]](sys.argv[2:])
+    print("Total Time Taken To Execute this Code: {:.2f} seconds".format(time.time() - start_time))
+elif __name__ == '__main__':
     parser = argparse.ArgumentParser(
         description='Process json files in a directory and present statistics about the runtimes per pipeline step.')
-    parser.add_argument("-d", "--directory", help='The directory to process.', required=True)
+    parser.add_argument("-d", "--directory", help='The directory to process, or a .tar(.gz), .zip or .ndjson(.gz) file. Optional with --index or -s.')
     parser.add_argument("-o", "--option", help="sort by slowest or fastest", choices=["slowest", "fastest"], required=True)
+    parser.add_argument("-e", "--engine", help="python (default), pandas (Test.py) or spark (JsonProcessingTool_Pyspark.py)",
+                        choices=["python", "pandas", "spark"], default="python")
+    parser.add_argument("-w", "--workers", help="number of worker processes used to parse the files", type=int, default=1)
+    parser.add_argument("--exact", help="keep every runtime and compute exact percentiles", action="store_true")
+    parser.add_argument("--error", help="rank error bound of the percentile sketch (default 0.01, or the one of the --index)",
+                        type=parse_error)
+    parser.add_argument("-k", help="number of slowest/fastest IDs to show (default 5)", type=parse_top, default=5)
+    parser.add_argument("--cache", help="directory caching the parsed records between runs, e.g. .jsonproc-cache")
+    parser.add_argument("--decoder", help="JSON backend, orjson when installed by default", choices=["auto"] + list(DECODERS), default="auto")
+    parser.add_argument("--read-ahead", help="number of files read ahead of the parser on a thread pool (default 0, off)", type=parse_read_ahead, default=0)
+    parser.add_argument("--read-ahead-memory", help="cap in MB on the bytes read ahead and not parsed yet (default 64)",
+                        type=parse_read_ahead_memory,
+                        default=READ_AHEAD_MEMORY >> 20)
+    parser.add_argument("-s", "--store", help="columnar store built by the compact subcommand; new files are appended to it and the report is computed from it")
+    parser.add_argument("--profile", help="write per-phase timings, throughput, errors and peak RSS as JSON to this file ('-' for stdout)")
+    parser.add_argument("--graph", help="JSON file with the [from, to] transitions of the state graph (default pipelines.json)")
+    parser.add_argument("--index", help="rollup index file; new files are added to it and the report is computed from it")
+    parser.add_argument("--from", dest="start", help="with --index, start of the time range, ISO date and time (UTC) or ms", type=parse_time)
+    parser.add_argument("--to", dest="end", help="with --index, end of the time range (excluded)", type=parse_time)
+    parser.add_argument("--bucket", help="with --index, print one report per minute, hour or day of the range", choices=list(BUCKETS))
+    parser.add_argument("--log-level", help="level of script.log, per-file messages are DEBUG (default INFO)",
+                        choices=["DEBUG", "INFO", "WARNING", "ERROR"], default="INFO")
+    parser.add_argument("--watch", help="stay resident and add new files as they land in the directory", action="store_true")
+    parser.add_argument("--socket", help="Unix domain socket answering stats/top/status queries in watch mode")
+    parser.add_argument("--interval", help="seconds between two polls of the directory in watch mode (default 1)", type=float, default=1.0)
     args = parser.parse_args()
-    process_directory(args.directory, args.option)
+    if not args.directory and (not (args.index or args.store) or args.watch):
+        parser.error("the following arguments are required: -d/--directory")
+    if args.directory and is_archive(args.directory) and (args.engine != "python" or args.watch):
+        parser.error("archives are read by the python engine only, and cannot be watched")
+    if (args.start is not None or args.end is not None or args.bucket) and not args.index:
+        parser.error("--from, --to and --bucket query a rollup index, give one with --index")
+    if args.engine != "python":
+        # The pandas and spark engines only take -d, -o and --graph (and -k for pandas)
+        python_only = [option for option, given in (("--watch", args.watch), ("-s", args.store), ("--exact", args.exact),
+                                                    ("-w", args.workers != 1), ("--cache", args.cache),
+                                                    ("--profile", args.profile)) if given]
+        if python_only:
+            parser.error("{} only apply to the python engine".format(", ".join(python_only)))
+    if args.index and (args.store or args.watch or args.engine != "python"):
+        parser.error("--index cannot be combined with --store, --watch or another engine")
+    if args.cache and os.path.isfile(args.cache):
+        parser.error("--cache must be a directory, {} is a file".format(args.cache))
+    if args.socket and os.path.lexists(args.socket) and not is_socket(args.socket):
+        parser.error("--socket must be a socket or a new path, {} exists".format(args.socket))
+    if args.error is None and not args.index:
+        args.error = 0.01
+    setup_logging(args.log_level)
+    pipelines = load_pipelines(args.graph) if args.graph else pipelinesMap
+    if args.engine == "pandas":
+        import Test
+        Test.process_directory(args.directory, args.option, args.k, pipelines)
+    elif args.engine == "spark":
+        # The Spark engine is a script of its own, run it with the same directory, option and graph
+        sys.argv = ["JsonProcessingTool_Pyspark.py", "-d", args.directory, "-o", args.option] + \
+                   (["--graph", args.graph] if args.graph else [])
+        runpy.run_path(os.path.join(os.path.dirname(os.path.abspath(__file__)), "JsonProcessingTool_Pyspark.py"),
+                       run_name="__main__")
+    elif args.watch:
+        watch_directory(args.directory, args.option, args.workers, args.exact, args.error, args.k, args.cache,
+                        args.decoder, args.socket, args.interval, args.read_ahead, args.read_ahead_memory << 20,
+                        pipelines)
+    else:
+        try:
+            process_directory(args.directory, args.option, args.workers, args.exact, args.error, args.k, args.cache,
+                              args.decoder, args.store, args.profile, args.read_ahead, args.read_ahead_memory << 20,
+                              pipelines, args.index, args.start, args.end, args.bucket)
+        except ValueError as e:
+            # An index built with another graph or a smaller -k
+            parser.error(str(e))
     end_time = time.time()
     time_taken = end_time - start_time
     print("Total Time Taken To Execute this Code: {:.2f} seconds".format(time_taken))
\ No newline at end of file
@@ -1,83 +1,97 @@
+#################################################################################################################################################################
+#Pandas
+#The script reads every JSON file of a directory into one dataframe of (id, state, utcTimeStamp) rows, pivots it once so that each state becomes a column
+# with the first timestamp per id, and computes the runtime of each transition of the state graph (pipelines.json, or --graph) as the difference
+# between two state columns.
+#Task 1 shows min, max, mean and the 10%/50%/90% percentiles per pipeline step with a single grouped quantile call, Task 2a the top 5 slowest/fastest
+# IDs per pipeline step and Task 2b the total processing time between PRE_PROCESSING and PIPELINE_FINISHED per ID.
+#e.g python <script.py> -d /path/to/directory -o <slowest/fastest> [-k 5] [--graph graph.json]
+#################################################################################################################################################################
 import os
-import pandas as pd
+import json
 import argparse
-import numpy as np
+import time
+import logging
+import pandas as pd
+
+from pipelines import pipelinesMap, load_pipelines
+
+start_time = time.time()
 
-parser = argparse.ArgumentParser()
-parser.add_argument("-d", "--directory", help="Directory containing pipeline stats")
-parser.add_argument("-o", "--option", choices=["slowest", "fastest"], help="Select slowest or fastest pipeline runs")
-args = parser.parse_args()
 
-folder = args.directory
-if os.path.exists(folder):
-    inputDF = pd.DataFrame()
+# Build the (id, state, utcTimeStamp) frame of all files in one go instead of concatenating one frame per file. The rows
+# of a file are only added once all of its stats entries have been read, so a malformed file is left out as a whole.
+def read_directory(folder):
+    ids, states, timestamps = [], [], []
     for filename in os.listdir(folder):
         if filename.endswith(".json"):
-            file_path = os.path.join(folder, filename)
-            fileDF = pd.read_json(file_path)
-            inputDF = pd.concat([inputDF, fileDF])
-    statsDF = pd.json_normalize(inputDF["stats"].tolist())
-    metricDF = statsDF.groupby(["id", "state"]).first().reset_index()
-    metricDF = metricDF[["id", "utcTimeStamp", "state"]].pivot(index="id", columns="state",
-                                                               values="utcTimeStamp").reset_index()
-else:
-    print("Folder not found at the given path: ", folder)
+            try:
+                with open(os.path.join(folder, filename), 'rb') as json_file:
+                    data = json.load(json_file)
+                id = data["id"]
+                file_states = [stat["state"] for stat in data["stats"]]
+                file_timestamps = [stat["utcTimeStamp"] for stat in data["stats"]]
+                ids.extend([id] * len(file_states))
+                states.extend(file_states)
+                timestamps.extend(file_timestamps)
+            except Exception as e:
+                logging.error("Error processing file: %s. Error: %s", filename, str(e))
+    return pd.DataFrame({"id": ids, "state": states, "utcTimeStamp": timestamps})
 
-pipelinesMap = [("NEW", "QUEUED_FOR_PROCESSING"),
-                ("QUEUED_FOR_PROCESSING", "PRE_PROCESSING"),
-                ("PRE_PROCESSING", "FILE_TO_TIFF_CONVERSION_PROCESSING"),
-                ("FILE_TO_TIFF_CONVERSION_PROCESSING", "FILE_TO_TIFF_CONVERSION_FINISHED"),
-                ("FILE_TO_TIFF_CONVERSION_FINISHED", "OCR_PROCESSING"),
-                ("OCR_PROCESSING", "OCR_FINISHED"),
-                ("OCR_FINISHED", "PRE_PROCESSING_FINISHED"),
-                ("PRE_PROCESSING_FINISHED", "PIPELINE_PROCESSING"),
-                ("PIPELINE_PROCESSING", "PIPELINE_FINISHED"),
-                ("PIPELINE_FINISHED", "POST_PROCESSING"),
-                ("POST_PROCESSING", "DOCUMENT_PROCESSED")]
 
-pipelineDF = metricDF
-for (v1, v2) in pipelinesMap:
-    try:
-        pipelineDF[f"{v1}____{v2}"] = pipelineDF[v2] - pipelineDF[v1]
-    except KeyError:
-        print(f"Columns {v1} and/or {v2} do not exist in the dataframe. Skipping calculation.")
+def process_directory(folder, option, k=5, pipelines=pipelinesMap):
+    inputDF = read_directory(folder)
 
-pipelineDF = pipelineDF[["id"] + [f"{v1}____{v2}" for (v1, v2) in pipelinesMap]]
+    # Unique values of the "state" column become separate columns, with the first "utcTimeStamp" of each id and state
+    metricDF = inputDF.drop_duplicates(["id", "state"]).pivot(index="id", columns="state", values="utcTimeStamp")
 
-pipelineStatsDF = pipelineDF.melt(id_vars=["id"], var_name="pipeline", value_name="time")
-pipelineStatsDF["pipeline"] = pipelineStatsDF["pipeline"].apply(lambda x: x.replace("____", " -> "))
-print(pipelineStatsDF["pipeline"])
+    pipelineDF = pd.DataFrame(index=metricDF.index)
+    for (v1, v2) in pipelines:
+        if v1 in metricDF.columns and v2 in metricDF.columns:
+            pipelineDF[f"{v1} -> {v2}"] = metricDF[v2] - metricDF[v1]
+        else:
+            print(f"Columns {v1} and/or {v2} do not exist in the dataframe. Skipping calculation.")
 
-aggColumn = "Time"
+    # One (id, PIPELINE, Time) row per id and pipeline step, in graph order
+    pipelineStatsDF = pipelineDF.reset_index().melt(id_vars=["id"], var_name="PIPELINE", value_name="Time").dropna()
+    pipelineGroups = pipelineStatsDF.groupby("PIPELINE", sort=False)["Time"]
 
-print("Task 1:\nProcess all files and present a statistic about the runtimes per pipeline step (min, max, 10%/50%/90% percentile and mean).")
-pipeline_stats = pipelineStatsDF.groupby("PIPELINE").agg({
-    "Time": [np.min, np.max, np.mean, lambda x: np.percentile(x, q=0.1),
-             lambda x: np.percentile(x, q=0.5), lambda x: np.percentile(x, q=0.9)]
-})
-print(pipeline_stats)
+    print("Task 1:\nProcess all files and present a statistic about the runtimes per pipeline step (min, max, 10%/50%/90% percentile and mean).")
+    # Without any runtime the unstacked quantiles have no columns at all, reindex them so the report is just empty
+    percentiles = pipelineGroups.quantile([0.1, 0.5, 0.9]).unstack().reindex(columns=[0.1, 0.5, 0.9])
+    percentiles.columns = ["percentile10", "percentile50", "percentile90"]
+    pipeline_stats = pd.concat([pipelineGroups.agg(["min", "max", "mean"]), percentiles], axis=1)
+    print(pipeline_stats.to_string())
 
-pipeline_stats = pipeline_stats.reset_index()
-pipeline_stats.columns = ['PIPELINE', 'min', 'max', 'mean', 'percentile10', 'percentile50', 'percentile90']
-pipeline_stats.sort_values(by=['PIPELINE'], inplace=True)
-print(pipeline_stats)
+    print(f"\nTask 2a:\nShow the top {k} {option} IDs per processing step.")
+    top_pipeline_df = pipelineStatsDF \
+        .sort_values("Time", ascending=(option == "fastest"), kind="stable") \
+        .groupby("PIPELINE", sort=False).head(k)
+    # Back to graph order, keeping the ranking within each step
+    top_pipeline_df = top_pipeline_df.assign(PIPELINE=pd.Categorical(top_pipeline_df["PIPELINE"], pipelineDF.columns)) \
+        .sort_values("PIPELINE", kind="stable")
+    print(top_pipeline_df.to_string(index=False))
 
-print("Task 2a:\n Show the top 5 slowest/fastest IDs per processing step. (Implement as switch via commandline option)")
+    print("\nTask 2b:\nShow the total processing time(ms) between the states: PRE_PROCESSING -> PIPELINE_FINISHED")
+    if "PRE_PROCESSING" in metricDF.columns and "PIPELINE_FINISHED" in metricDF.columns:
+        metric_df = metricDF[["PRE_PROCESSING", "PIPELINE_FINISHED"]].reset_index()
+        metric_df["PROCESSING_TIME"] = metric_df["PIPELINE_FINISHED"] - metric_df["PRE_PROCESSING"]
+        print(metric_df)
+    else:
+        print("Columns PRE_PROCESSING and/or PIPELINE_FINISHED do not exist in the dataframe. Skipping calculation.")
 
-if args.option == "fastest":
-    pipeline_stats.sort_values(by=['Time'], inplace=True)
-    pipeline_stats = pipeline_stats.head(5)
-    pipeline_stats.sort_values(by=['PIPELINE'], inplace=True)
-elif args.option == "slowest":
-    pipeline_stats.sort_values(by=['Time'], inplace=True, ascending=False)
-    pipeline_stats = pipeline_stats.head(5)
-    pipeline_stats.sort_values(by=['PIPELINE'], inplace=True)
-else:
-    raise ValueError(f"Invalid option: {option}")
 
-print(pipeline_stats)
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-d", "--directory", help="Directory containing pipeline stats", required=True)
+    parser.add_argument("-o", "--option", choices=["slowest", "fastest"], help="Select slowest or fastest pipeline runs", required=True)
+    parser.add_argument("-k", help="number of slowest/fastest IDs to show per pipeline step (default 5)", type=int, default=5)
+    parser.add_argument("--graph", help="JSON file with the [from, to] transitions of the state graph (default pipelines.json)")
+    args = parser.parse_args()
 
-print("Task 2b:\n Show the total processing time(ms) between the states: PRE_PROCESSING -> PIPELINE_FINISHED")
-metric_df = metricDF[["ID", "PRE_PROCESSING", "PIPELINE_FINISHED"]]
-metric_df['PROCESSING_TIME'] = metric_df["PIPELINE_FINISHED"] - metric_df["PRE_PROCESSING"]
-print(metric_df)
+    folder = args.directory
+    if os.path.exists(folder):
+        process_directory(folder, args.option, args.k, load_pipelines(args.graph) if args.graph else pipelinesMap)
+    else:
+        print("Folder not found at the given path: ", folder)
+    print("Total time taken to execute the code: {:.2f} seconds".format(time.time() - start_time))
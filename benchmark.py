@@ -0,0 +1,153 @@
+#################################################################################################################################################################
+#Benchmark
+#Runs each engine (JsonProcessingTool_Python.py, Test.py, JsonProcessingTool_Pyspark.py) on synthetic Metrics directories of 1k, 100k and 1M documents
+# made by generate_metrics.py, and records wall time, files/s and peak RSS of every run in a JSON baseline. Each size is run --repeat times and the best
+# wall time is kept, so interpreter startup and noise do not dominate the small sizes. Given a previous baseline, any run that got slower by more than
+# the tolerance is reported and the script exits with status 1. A baseline made with other generator settings or --python-args is refused.
+#
+#--sizes : comma separated numbers of documents (default 1000,100000,1000000)
+#--engines : comma separated engines among python, pandas and spark (default: the ones whose libraries are installed)
+#--data : directory keeping the generated corpora between runs (default bench-data)
+#--skew, --missing, --malformed : passed to the generator
+#--repeat : runs per engine and size, the fastest one is recorded (default 3)
+#--output : where to write the results (default bench-baseline.json), --baseline : previous results to compare with, --tolerance : default 0.2
+#e.g python benchmark.py --sizes 1000,100000 --engines python,pandas --baseline bench-baseline.json
+#################################################################################################################################################################
+import argparse
+import importlib.util
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+from generate_metrics import generate
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Command line of each engine, run with "-d <directory> -o slowest"
+ENGINES = {"python": [sys.executable, os.path.join(HERE, "JsonProcessingTool_Python.py")],
+           "pandas": [sys.executable, os.path.join(HERE, "Test.py")],
+           "spark": [sys.executable, os.path.join(HERE, "JsonProcessingTool_Pyspark.py"), "--master", "local[*]"]}
+
+# Library each engine needs besides the standard library
+ENGINE_MODULES = {"python": "numpy", "pandas": "pandas", "spark": "pyspark"}
+
+
+# Generate the corpus of the given size once, and reuse it as long as the generator settings are the same
+def corpus(data, size, skew, missing, malformed):
+    directory = os.path.join(data, "metrics-{}-skew{}-missing{}-malformed{}".format(size, skew, missing, malformed))
+    marker = os.path.join(directory, ".complete")
+    if not os.path.exists(marker):
+        print("Generating {} documents in {}".format(size, directory))
+        generate(directory, size, skew=skew, missing=missing, malformed=malformed)
+        open(marker, "w").close()
+    return directory
+
+
+# Run one engine on one directory, returning its wall time and peak RSS. os.wait4 gives the resource usage of that
+# child alone.
+def run_engine(engine, directory, extra_args):
+    command = ENGINES[engine] + ["-d", directory, "-o", "slowest"] + extra_args
+    started = time.perf_counter()
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, cwd=HERE)
+    stderr = process.stderr.read()
+    _, status, usage = os.wait4(process.pid, 0)
+    seconds = time.perf_counter() - started
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode:
+        print("{} failed on {}:\n{}".format(engine, directory, stderr.decode(errors="replace")[-2000:]))
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak_rss = usage.ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+    return seconds, peak_rss, process.returncode
+
+
+# Best wall time of `repeat` runs of one engine on one directory, with the highest peak RSS of those runs and the
+# first non-zero return code
+def best_run(engine, directory, extra_args, repeat):
+    runs = [run_engine(engine, directory, extra_args) for _ in range(repeat)]
+    seconds = min(run[0] for run in runs)
+    peak_rss = max(run[1] for run in runs)
+    returncode = next((run[2] for run in runs if run[2]), 0)
+    return seconds, peak_rss, returncode
+
+
+# Settings of the run that the timings depend on, which must match the baseline for the comparison to mean anything
+def run_settings(args):
+    return {"generator": {"skew": args.skew, "missing": args.missing, "malformed": args.malformed},
+            "python_args": args.python_args}
+
+
+# Descriptions of the settings that differ between the baseline and this run
+def settings_mismatch(baseline, settings):
+    return ["{}: {!r} in the baseline, {!r} now".format(name, baseline.get(name), value)
+            for name, value in settings.items() if baseline.get(name) != value]
+
+
+# Runs that are slower than in the baseline by more than the tolerance
+def regressions(results, baseline, tolerance):
+    previous = {(result["engine"], result["files"]): result for result in baseline["results"]}
+    slower = []
+    for result in results:
+        before = previous.get((result["engine"], result["files"]))
+        if before and before["returncode"] == 0 and result["returncode"] == 0 \
+                and result["seconds"] > before["seconds"] * (1 + tolerance):
+            slower.append((result, before))
+    return slower
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the engines on synthetic Metrics directories.')
+    parser.add_argument("--sizes", help="comma separated numbers of documents", default="1000,100000,1000000")
+    parser.add_argument("--engines", help="comma separated engines: python, pandas, spark",
+                        default=",".join(engine for engine, module in ENGINE_MODULES.items() if importlib.util.find_spec(module)))
+    parser.add_argument("--data", help="directory keeping the generated corpora", default=os.path.join(HERE, "bench-data"))
+    parser.add_argument("--skew", type=float, default=1.0)
+    parser.add_argument("--missing", type=float, default=0.0)
+    parser.add_argument("--malformed", type=float, default=0.0)
+    parser.add_argument("--python-args", help="extra arguments for the python engine, e.g. \"-w 8 --exact\"", default="")
+    parser.add_argument("--repeat", help="runs per engine and size, the fastest is kept (default 3)", type=int, default=3)
+    parser.add_argument("--output", help="file the results are written to", default="bench-baseline.json")
+    parser.add_argument("--baseline", help="previous results to compare with")
+    parser.add_argument("--tolerance", help="allowed slowdown against the baseline (default 0.2)", type=float, default=0.2)
+    args = parser.parse_args()
+    if args.repeat < 1:
+        parser.error("--repeat must be at least 1")
+
+    settings = run_settings(args)
+    baseline = None
+    if args.baseline:
+        # Checked before the runs, a baseline of another corpus or other engine arguments cannot be compared with
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        mismatch = settings_mismatch(baseline, settings)
+        if mismatch:
+            parser.error("the baseline {} was made with other settings: {}".format(args.baseline, "; ".join(mismatch)))
+        if (baseline.get("machine"), baseline.get("cpus")) != (platform.machine(), os.cpu_count()):
+            print("Warning: the baseline was made on another machine ({} with {} CPUs)".format(
+                baseline.get("machine"), baseline.get("cpus")))
+
+    results = []
+    for size in [int(size) for size in args.sizes.split(",")]:
+        directory = corpus(args.data, size, args.skew, args.missing, args.malformed)
+        for engine in args.engines.split(","):
+            extra_args = args.python_args.split() if engine == "python" else []
+            seconds, peak_rss, returncode = best_run(engine, directory, extra_args, args.repeat)
+            results.append({"engine": engine, "files": size, "seconds": round(seconds, 3),
+                            "files_per_second": round(size / seconds, 1), "peak_rss_bytes": peak_rss,
+                            "returncode": returncode, "repeat": args.repeat})
+            print("{:<7} {:>9} files {:>9.2f}s {:>12.1f} files/s {:>8.1f} MB peak RSS".format(
+                engine, size, seconds, size / seconds, peak_rss / 1e6))
+
+    with open(args.output, "w") as output_file:
+        json.dump(dict({"python": platform.python_version(), "machine": platform.machine(), "cpus": os.cpu_count()},
+                       **settings, results=results), output_file, indent=2)
+
+    if baseline is not None:
+        slower = regressions(results, baseline, args.tolerance)
+        for result, before in slower:
+            print("Regression: {} on {} files took {:.2f}s, {:.2f}s in the baseline".format(
+                result["engine"], result["files"], result["seconds"], before["seconds"]))
+        if slower:
+            sys.exit(1)
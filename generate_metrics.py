@@ -0,0 +1,77 @@
+#################################################################################################################################################################
+#Synthetic Metrics generator
+#Writes documents shaped like the real Metrics/ files: an "id" and a "stats" list with one {"id", "state", "utcTimeStamp"} entry per state of the pipeline,
+# from NEW to DOCUMENT_PROCESSED, with increasing millisecond timestamps. The same seed always gives the same files.
+#
+#-d : output directory, -n : number of documents, --seed : random seed (default 0)
+#--skew : sigma of the lognormal factor applied to each step runtime, 0 gives evenly spread runtimes (default 1.0)
+#--missing : probability that a state is left out of a document (default 0)
+#--malformed : probability that a file is written truncated and cannot be parsed (default 0)
+#-f : json writes one file per document (default), ndjson writes all documents as lines of one metrics.ndjson file
+#e.g python generate_metrics.py -d /path/to/Metrics -n 100000 --skew 1.5 --missing 0.01 --malformed 0.001
+#################################################################################################################################################################
+import argparse
+import json
+import os
+import random
+
+from pipelines import pipelinesMap
+
+# States of the pipeline in order
+STATES = [pipelinesMap[0][0]] + [v2 for (v1, v2) in pipelinesMap]
+
+# Median runtime in ms of each step of pipelinesMap, OCR being the slow part
+STEP_RUNTIMES = {"OCR_FINISHED": 60000, "PIPELINE_FINISHED": 30000, "FILE_TO_TIFF_CONVERSION_FINISHED": 8000}
+DEFAULT_STEP_RUNTIME = 1500
+
+# 2020-01-01 UTC in ms, documents start within the 30 days after it
+START = 1577836800000
+SPREAD = 30 * 24 * 3600 * 1000
+
+
+# One document. Each step takes its median runtime times a lognormal factor, the larger the skew the longer the tail.
+def make_document(rng, index, skew, missing):
+    id = "{}_{:015d}".format(index, rng.randrange(10 ** 15))
+    timestamp = START + rng.randrange(SPREAD)
+    stats = []
+    for state in STATES:
+        if state != STATES[0]:
+            timestamp += max(1, int(STEP_RUNTIMES.get(state, DEFAULT_STEP_RUNTIME) * rng.lognormvariate(0, skew)))
+        if missing and rng.random() < missing:
+            continue
+        stats.append({"id": id, "state": state, "utcTimeStamp": timestamp})
+    return {"id": id, "stats": stats}
+
+
+def generate(directory, count, seed=0, skew=1.0, missing=0.0, malformed=0.0, format="json"):
+    rng = random.Random(seed)
+    os.makedirs(directory, exist_ok=True)
+    ndjson_file = open(os.path.join(directory, "metrics.ndjson"), "w") if format == "ndjson" else None
+    try:
+        for index in range(count):
+            data = make_document(rng, index, skew, missing)
+            document = json.dumps(data)
+            if malformed and rng.random() < malformed:
+                # Cut the document in half, like a file that was still being written
+                document = document[:len(document) // 2]
+            if ndjson_file is not None:
+                ndjson_file.write(document + "\n")
+            else:
+                with open(os.path.join(directory, data["id"] + ".json"), "w") as json_file:
+                    json_file.write(document)
+    finally:
+        if ndjson_file is not None:
+            ndjson_file.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate synthetic pipeline metrics documents.')
+    parser.add_argument("-d", "--directory", help="output directory", required=True)
+    parser.add_argument("-n", "--count", help="number of documents", type=int, required=True)
+    parser.add_argument("--seed", help="random seed (default 0)", type=int, default=0)
+    parser.add_argument("--skew", help="sigma of the lognormal step runtime factor (default 1.0)", type=float, default=1.0)
+    parser.add_argument("--missing", help="probability that a state is missing from a document (default 0)", type=float, default=0.0)
+    parser.add_argument("--malformed", help="probability that a file is truncated (default 0)", type=float, default=0.0)
+    parser.add_argument("-f", "--format", help="one file per document (json) or one ndjson file", choices=["json", "ndjson"], default="json")
+    args = parser.parse_args()
+    generate(args.directory, args.count, args.seed, args.skew, args.missing, args.malformed, args.format)
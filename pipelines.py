@@ -0,0 +1,29 @@
+#The state graph of the processing pipeline. Each transition is a (from state, to state) pair and its runtime is the time between the two states
+#inside one document. The default graph is read from pipelines.json next to this file; another one can be given to the engines with --graph.
+#Shared by the python (JsonProcessingTool_Python.py), pandas (Test.py) and Spark (JsonProcessingTool_Pyspark.py) engines.
+import json
+import os
+
+DEFAULT_GRAPH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "pipelines.json")
+
+
+#Read the transitions of a state graph, a JSON list of [from, to] pairs in report order
+def load_pipelines(path=DEFAULT_GRAPH):
+    with open(path) as graph_file:
+        transitions = json.load(graph_file)
+    pipelines = []
+    for transition in transitions:
+        if len(transition) != 2 or not all(isinstance(state, str) for state in transition):
+            raise ValueError("Invalid transition in {}: {}".format(path, transition))
+        pipelines.append(tuple(transition))
+    if not pipelines:
+        raise ValueError("No transitions in {}".format(path))
+    return pipelines
+
+
+#States of the graph in order of first appearance
+def pipeline_states(pipelines):
+    return list(dict.fromkeys(state for pipeline in pipelines for state in pipeline))
+
+
+pipelinesMap = load_pipelines()
@@ -0,0 +1,803 @@
+#################################################################################################################################################################
+#Checks of JsonProcessingTool_Python.py with the standard library's unittest: the rank error of the KLL sketch, TopK.extend/merge against TopK.add, and
+# that -w, --cache, the columnar store (-s) and map/reduce give the same numbers as a serial run on a generated corpus.
+#e.g python -m unittest test_JsonProcessingTool
+#################################################################################################################################################################
+import argparse
+import bisect
+import gzip
+import contextlib
+import io
+import logging
+import os
+import random
+import json
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+import unittest
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from unittest import mock
+
+import numpy as np
+
+import JsonProcessingTool_Python as tool
+from generate_metrics import generate
+
+
+def setUpModule():
+    # The malformed files of the corpus are logged as errors
+    logging.disable(logging.CRITICAL)
+
+
+def tearDownModule():
+    logging.disable(logging.NOTSET)
+
+
+# Rank of the value among the sorted values, as a fraction
+def rank(sorted_values, value):
+    return bisect.bisect_right(sorted_values, value) / len(sorted_values)
+
+
+# Run the command line of the tool in the given directory, where it writes its script.log
+def run_tool(*args, cwd=None):
+    return subprocess.run([sys.executable, os.path.abspath(tool.__file__)] + list(args), cwd=cwd,
+                          capture_output=True, text=True)
+
+
+class QuantileSketchTest(unittest.TestCase):
+    error = 0.01
+
+    def assert_rank_error(self, sketch, values):
+        sorted_values = sorted(values)
+        for q in (0.1, 0.5, 0.9):
+            self.assertLessEqual(abs(rank(sorted_values, sketch.quantile(q)) - q), 2 * self.error)
+
+    def test_rank_error(self):
+        rng = random.Random(1)
+        values = [int(rng.lognormvariate(8, 1.5)) for _ in range(100000)]
+        sketch = tool.QuantileSketch(self.error)
+        for value in values:
+            sketch.add(value)
+        self.assertLess(sketch.size, 10 * sketch.k)
+        self.assert_rank_error(sketch, values)
+
+    def test_extend_and_merge(self):
+        rng = random.Random(2)
+        values = [rng.randint(0, 10 ** 6) for _ in range(50000)]
+        extended = tool.QuantileSketch(self.error)
+        extended.extend(values)
+        self.assert_rank_error(extended, values)
+        left, right = tool.QuantileSketch(self.error), tool.QuantileSketch(self.error)
+        left.extend(values[:20000])
+        right.extend(values[20000:])
+        left.merge(right)
+        self.assert_rank_error(left, values)
+
+    def test_sketch_stats_merge(self):
+        values = list(range(1000, 0, -1))
+        merged = tool.SketchStats(self.error)
+        merged.extend(values[:300])
+        other = tool.SketchStats(self.error)
+        other.extend(values[300:])
+        merged.merge(other)
+        self.assertEqual((len(merged), merged.min, merged.max, merged.total), (1000, 1, 1000, sum(values)))
+
+    def test_parse_error(self):
+        self.assertEqual(tool.parse_error("0.005"), 0.005)
+        for value in ("0", "-0.1", "1", "nan", "x"):
+            with self.assertRaises(argparse.ArgumentTypeError, msg=value):
+                tool.parse_error(value)
+
+
+class TopKTest(unittest.TestCase):
+    def stream(self):
+        # Few distinct values, so the ties have to keep the first arrivals
+        rng = random.Random(3)
+        return [rng.randint(0, 20) for _ in range(500)], ["id{}".format(i) for i in range(500)]
+
+    def added(self, values, ids, option, k=5):
+        top = tool.TopK(k, option)
+        for value, id in zip(values, ids):
+            top.add(value, id)
+        return top
+
+    def test_extend_matches_add(self):
+        values, ids = self.stream()
+        for option in ("slowest", "fastest"):
+            extended = tool.TopK(5, option)
+            for start in range(0, len(values), 64):
+                extended.extend(values[start:start + 64], ids[start:start + 64])
+            self.assertEqual(extended.items(), self.added(values, ids, option).items())
+
+    def test_merge_matches_add(self):
+        values, ids = self.stream()
+        for option in ("slowest", "fastest"):
+            merged = tool.TopK(5, option)
+            for start in range(0, len(values), 100):
+                merged.merge(self.added(values[start:start + 100], ids[start:start + 100], option))
+            self.assertEqual(merged.items(), self.added(values, ids, option).items())
+
+    def test_from_values_matches_add(self):
+        values, ids = self.stream()
+        for option in ("slowest", "fastest"):
+            top = tool.TopK.from_values(np.array(values), np.array(ids), 5, option)
+            self.assertEqual(top.items(), self.added(values, ids, option).items())
+
+    def test_parse_top(self):
+        self.assertEqual(tool.parse_top("10"), 10)
+        for value in ("0", "-3", "2.5", "x"):
+            with self.assertRaises(argparse.ArgumentTypeError, msg=value):
+                tool.parse_top(value)
+
+
+class TransitionsTest(unittest.TestCase):
+    graph = [("NEW", "QUEUED"), ("QUEUED", "DONE")]
+
+    def test_first_timestamps_are_paired(self):
+        transitions = tool.Transitions(self.graph)
+        # Out of order, with a repeated state and a state that is not in the graph
+        stats = [("QUEUED", 30), ("NEW", 10), ("OTHER", 5), ("QUEUED", 70), ("DONE", 100), ("NEW", 90)]
+        self.assertEqual(transitions.runtimes(stats), ([(0, 20), (1, 70)], True))
+
+    def test_incomplete_documents(self):
+        aggregate = tool.Aggregate("slowest", True, k=2, pipelines=self.graph)
+        aggregate.add_record("a", [("NEW", 0), ("QUEUED", 5), ("DONE", 9)])
+        # Lacks DONE, still gives the runtime of its first transition
+        aggregate.add_record("b", [("NEW", 0), ("QUEUED", 7)])
+        aggregate.add_record("c", [])
+        self.assertEqual((aggregate.documents, aggregate.incomplete), (3, 2))
+        self.assertEqual([len(stats) for stats in aggregate.step_stats], [2, 1])
+        self.assertEqual(aggregate.top["NEW -> QUEUED"].items(), [("b", 7), ("a", 5)])
+
+    def test_float_timestamps(self):
+        temp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp)
+        documents = [("a", [0, 5, 9]), ("b", [0.5, 7.25, 8]), ("c", [1, 3, 4])]
+        for id, timestamps in documents:
+            with open(os.path.join(temp, id + ".json"), "w") as json_file:
+                json.dump({"id": id, "stats": [{"state": state, "utcTimeStamp": timestamp}
+                                               for state, timestamp in zip(["NEW", "QUEUED", "DONE"], timestamps)]},
+                          json_file)
+        filenames = sorted(tool.list_json_files(temp))
+        for exact, workers in ((True, 1), (True, 2), (False, 2)):
+            aggregate = tool.Aggregate("slowest", exact, k=2, pipelines=self.graph)
+            tool.load_files(aggregate, temp, filenames, tool.Decoder(), workers)
+            summary = aggregate.summaries()["NEW -> QUEUED"]
+            self.assertEqual(summary[:3], (2, 6.75, (5 + 6.75 + 2) / 3), (exact, workers))
+        # Integer runtimes added after a float one
+        stats = tool.ExactStats()
+        for runtime in (3, 1.5, 2):
+            stats.add(runtime)
+        other = tool.ExactStats()
+        other.add(4)
+        stats.merge(other)
+        self.assertEqual(stats.summary()[:3], (1.5, 4.0, 2.625))
+
+    def test_graph_file(self):
+        temp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp)
+        path = os.path.join(temp, "graph.json")
+        with open(path, "w") as graph_file:
+            json.dump([list(pipeline) for pipeline in self.graph], graph_file)
+        self.assertEqual(tool.load_pipelines(path), self.graph)
+        for transitions in ([], [["NEW"]], [["NEW", 1]]):
+            with open(path, "w") as graph_file:
+                json.dump(transitions, graph_file)
+            with self.assertRaises(ValueError, msg=transitions):
+                tool.load_pipelines(path)
+
+    def test_graph_option(self):
+        temp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp)
+        directory = os.path.join(temp, "metrics")
+        generate(directory, 30, seed=9)
+        path = os.path.join(temp, "graph.json")
+        with open(path, "w") as graph_file:
+            json.dump([["NEW", "OCR_FINISHED"], ["OCR_FINISHED", "DOCUMENT_PROCESSED"]], graph_file)
+        result = run_tool("-d", directory, "-o", "slowest", "--exact", "--graph", path, cwd=temp)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        steps = [line.split(" : ")[0] for line in result.stdout.splitlines() if " : " in line]
+        self.assertEqual(steps, ["NEW -> OCR_FINISHED", "OCR_FINISHED -> DOCUMENT_PROCESSED"])
+        self.assertIn("Incomplete documents (missing a state of the pipeline graph): 0 of 30", result.stdout)
+
+
+# Every mode of the python engine against a serial run over the same generated directory
+class ModeParityTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.temp = tempfile.mkdtemp()
+        cls.directory = os.path.join(cls.temp, "metrics")
+        generate(cls.directory, 400, seed=5, missing=0.02, malformed=0.02)
+        cls.filenames = tool.list_json_files(cls.directory)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.temp)
+
+    def aggregate(self, exact=True, workers=1, cache_path=None):
+        aggregate = tool.Aggregate("slowest", exact, k=5)
+        tool.load_files(aggregate, self.directory, self.filenames, tool.Decoder(), workers, cache_path)
+        return aggregate
+
+    # Everything but the percentiles, which a sketch only bounds
+    def assert_same_counts(self, aggregate, expected):
+        self.assertEqual((aggregate.documents, aggregate.incomplete), (expected.documents, expected.incomplete))
+        self.assertEqual([len(stats) for stats in aggregate.step_stats], [len(stats) for stats in expected.step_stats])
+        for (pipeline_step, summary), expected_summary in zip(aggregate.summaries().items(), expected.summaries().values()):
+            self.assertEqual(summary[:2], expected_summary[:2], pipeline_step)
+            self.assertAlmostEqual(summary[2], expected_summary[2], msg=pipeline_step)
+        self.assertEqual(aggregate.top_times.items(), expected.top_times.items())
+        self.assertEqual([top.items() for top in aggregate.step_top], [top.items() for top in expected.step_top])
+
+    def assert_same(self, aggregate, expected):
+        self.assert_same_counts(aggregate, expected)
+        self.assertEqual(aggregate.summaries(), expected.summaries())
+
+    def test_corpus_has_malformed_and_incomplete_documents(self):
+        serial = self.aggregate()
+        self.assertLess(serial.documents, len(self.filenames))
+        self.assertGreater(serial.incomplete, 0)
+
+    def test_workers(self):
+        self.assert_same(self.aggregate(workers=2), self.aggregate())
+        # Merged sketches only bound the percentiles
+        serial = self.aggregate(exact=False)
+        self.assert_same_counts(self.aggregate(exact=False, workers=2), serial)
+        merged = self.aggregate(exact=False, workers=4)
+        self.assert_same_counts(merged, serial)
+        for sketch_stats, exact_stats in zip(merged.step_stats, self.aggregate().step_stats):
+            runtimes = sorted(exact_stats.runtimes)
+            for q in (0.1, 0.5, 0.9):
+                self.assertLessEqual(abs(rank(runtimes, sketch_stats.sketch.quantile(q)) - q), 2 * merged.error)
+
+    def test_read_ahead(self):
+        serial = self.aggregate()
+        # A cap of 0 or below the size of one file still reads one file at a time
+        for read_ahead, memory in ((4, tool.READ_AHEAD_MEMORY), (4, 0), (3, 1), (1, 1 << 10)):
+            aggregate = tool.Aggregate("slowest", True, k=5)
+            decoder = tool.Decoder(read_ahead=read_ahead, read_ahead_memory=memory)
+            tool.load_files(aggregate, self.directory, self.filenames, decoder)
+            self.assert_same(aggregate, serial)
+            self.assertEqual((decoder.files, decoder.errors),
+                             (len(self.filenames), len(self.filenames) - serial.documents))
+
+    # Files read and not parsed yet, at most, while parsing with the given read-ahead and cap
+    def peak_read_ahead(self, read_ahead, memory):
+        lock = threading.Lock()
+        counts = {"outstanding": 0, "peak": 0}
+
+        class CountingFile:
+            def __init__(self, path, mode):
+                self.file = open(path, mode)
+
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *exc_info):
+                self.file.close()
+
+            def fileno(self):
+                return self.file.fileno()
+
+            def read(self):
+                content = self.file.read()
+                with lock:
+                    counts["outstanding"] += 1
+                    counts["peak"] = max(counts["peak"], counts["outstanding"])
+                return content
+
+        decoder = tool.Decoder(read_ahead=read_ahead, read_ahead_memory=memory)
+        parse_content = decoder.parse_content
+
+        def slow_parse_content(content, read_seconds):
+            time.sleep(0.002)
+            with lock:
+                counts["outstanding"] -= 1
+            return parse_content(content, read_seconds)
+
+        decoder.parse_content = slow_parse_content
+        with mock.patch.object(tool, "open", CountingFile, create=True), \
+                mock.patch.object(tool, "json_file_signatures", side_effect=AssertionError("the directory was listed")):
+            results = list(decoder.parse_all(self.directory, self.filenames[:40]))
+        self.assertEqual([filename for filename, _ in results], self.filenames[:40])
+        return counts["peak"]
+
+    def test_read_ahead_memory_cap(self):
+        # Reads in flight count against the cap, a cap below one file reads one file at a time
+        self.assertEqual(self.peak_read_ahead(4, 1), 1)
+        self.assertGreater(self.peak_read_ahead(4, tool.READ_AHEAD_MEMORY), 1)
+        # Stopping early does not leave readers waiting for room
+        results = tool.Decoder(read_ahead=4, read_ahead_memory=1).parse_all(self.directory, self.filenames)
+        next(results)
+        results.close()
+
+    def test_read_ahead_of_a_removed_file(self):
+        decoder = tool.Decoder(read_ahead=2)
+        results = list(decoder.parse_all(self.directory, self.filenames[:3] + ["removed.json"]))
+        self.assertEqual([filename for filename, _ in results], self.filenames[:3] + ["removed.json"])
+        self.assertIsInstance(results[-1][1], FileNotFoundError)
+
+    def test_read_ahead_arguments(self):
+        self.assertEqual((tool.parse_read_ahead("0"), tool.parse_read_ahead_memory("1")), (0, 1))
+        for parse, value in ((tool.parse_read_ahead, "-1"), (tool.parse_read_ahead_memory, "0"),
+                             (tool.parse_read_ahead_memory, "x")):
+            with self.assertRaises(argparse.ArgumentTypeError, msg=value):
+                parse(value)
+        result = run_tool("-d", self.directory, "-o", "slowest", "--read-ahead", "4", "--read-ahead-memory", "0",
+                          cwd=self.temp)
+        self.assertEqual(result.returncode, 2)
+
+    def test_archives(self):
+        paths = []
+        for suffix, mode in ((".tar", "w"), (".tar.gz", "w:gz")):
+            paths.append(os.path.join(self.temp, "metrics" + suffix))
+            with tarfile.open(paths[-1], mode) as tar_file:
+                for filename in self.filenames:
+                    tar_file.add(os.path.join(self.directory, filename), "metrics/" + filename)
+        paths.append(os.path.join(self.temp, "metrics.zip"))
+        with zipfile.ZipFile(paths[-1], "w", zipfile.ZIP_DEFLATED) as zip_file:
+            zip_file.writestr("metrics/", "")
+            for filename in self.filenames:
+                zip_file.write(os.path.join(self.directory, filename), "metrics/" + filename)
+        # The same documents as lines of one file, plain and gzipped
+        ndjson_directory = os.path.join(self.temp, "ndjson")
+        generate(ndjson_directory, 400, seed=5, missing=0.02, malformed=0.02, format="ndjson")
+        paths.append(os.path.join(ndjson_directory, "metrics.ndjson"))
+        with open(paths[-1], "rb") as ndjson_file, gzip.open(paths[-1] + ".gz", "wb") as gzip_file:
+            shutil.copyfileobj(ndjson_file, gzip_file)
+        paths.append(paths[-1] + ".gz")
+
+        serial = self.aggregate()
+        self.assertFalse(tool.is_archive(self.directory))
+        for path in paths:
+            self.assertTrue(tool.is_archive(path), path)
+            aggregate = tool.Aggregate("slowest", True, k=5)
+            decoder = tool.Decoder()
+            for name, record in tool.archive_records(path, decoder):
+                if record is not None:
+                    aggregate.add_record(*record)
+            self.assert_same(aggregate, serial)
+            self.assertEqual(decoder.errors, len(self.filenames) - serial.documents, path)
+        names = [name for name, _ in tool.iter_members(paths[-1])]
+        self.assertEqual(names[:2], ["metrics.ndjson.gz:1", "metrics.ndjson.gz:2"])
+
+    def test_parse_batch_in_a_kept_pool(self):
+        expected = tool.parse_batch(self.directory, self.filenames, tool.Decoder())
+        with ProcessPoolExecutor(max_workers=2) as executor, \
+                mock.patch.object(tool, "worker_pool", side_effect=AssertionError("a new pool was started")):
+            # Two batches in the same workers, like two polls of watch mode
+            for _ in range(2):
+                self.assertEqual(tool.parse_batch(self.directory, self.filenames, tool.Decoder(), 2, executor), expected)
+
+    def test_cache(self):
+        cache_path = os.path.join(self.temp, "cache")
+        serial = self.aggregate()
+        # Cold, then warm
+        self.assert_same(self.aggregate(cache_path=cache_path), serial)
+        self.assert_same(self.aggregate(cache_path=cache_path), serial)
+        self.assertTrue(os.path.isdir(cache_path))
+
+    def test_cache_round_trip(self):
+        cache_path = os.path.join(self.temp, "round-trip-cache")
+        entries = {"a.json": (10, 1, ("a", [("NEW", 1), ("DONE", 2)])),
+                   "b.json": (20, 2, (7, [])),
+                   "c.json": (30, 3, ("c", [("NEW", 1.5), ("DONE", 4)]))}
+        tool.save_cache(cache_path, "/metrics", entries)
+        self.assertEqual(tool.load_cache(cache_path, "/metrics"), entries)
+        # Plain arrays only, no pickled objects
+        with np.load(tool.cache_file_path(cache_path, "/metrics"), allow_pickle=False) as cache_file:
+            self.assertNotIn("timestamps", cache_file.files)
+        del entries["c.json"]
+        tool.save_cache(cache_path, "/metrics", entries)
+        self.assertEqual(tool.load_cache(cache_path, "/metrics"), entries)
+        self.assertEqual(tool.load_cache(cache_path, "/other"), {})
+
+    def test_cache_refuses_a_file(self):
+        path = os.path.join(self.temp, "notes.txt")
+        with open(path, "w") as text_file:
+            text_file.write("not a cache")
+        result = run_tool("-d", self.directory, "-o", "slowest", "--cache", path, cwd=self.temp)
+        self.assertEqual(result.returncode, 2)
+        self.assertIn("--cache must be a directory", result.stderr)
+        with open(path) as text_file:
+            self.assertEqual(text_file.read(), "not a cache")
+
+    def test_store(self):
+        store = os.path.join(self.temp, "store")
+        tool.compact_directory(self.directory, store, tool.Decoder())
+        aggregate = tool.Aggregate("slowest", True, k=5)
+        aggregate.load_columns(*tool.load_store(store))
+        self.assert_same(aggregate, self.aggregate())
+
+    def test_store_without_directory(self):
+        store = os.path.join(self.temp, "read-only-store")
+        tool.compact_directory(self.directory, store, tool.Decoder())
+        result = run_tool("-s", store, "-o", "slowest", cwd=self.temp)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        expected = run_tool("-d", self.directory, "-o", "slowest", "--exact", cwd=self.temp)
+        # The same report, and nothing parsed
+        self.assertEqual(result.stdout.split("Parse throughput")[0], expected.stdout.split("Parse throughput")[0])
+        self.assertIn("Parse throughput (", result.stdout)
+        self.assertIn(" 0 files", result.stdout)
+
+    def test_store_appends_new_files(self):
+        store = os.path.join(self.temp, "appended-store")
+        directory = os.path.join(self.temp, "appended")
+        os.makedirs(directory)
+        for filename in self.filenames[:150]:
+            shutil.copy(os.path.join(self.directory, filename), directory)
+        tool.compact_directory(directory, store, tool.Decoder())
+        for filename in self.filenames[150:]:
+            shutil.copy(os.path.join(self.directory, filename), directory)
+        tool.compact_directory(directory, store, tool.Decoder())
+        # Nothing new, no segment
+        manifest = tool.compact_directory(directory, store, tool.Decoder())
+        self.assertEqual([segment["name"] for segment in manifest["segments"]], ["segment-000000", "segment-000001"])
+        self.assertEqual(sum(segment["documents"] for segment in manifest["segments"]), self.aggregate().documents)
+        aggregate = tool.Aggregate("slowest", True, k=5)
+        aggregate.load_columns(*tool.load_store(store))
+        self.assert_same_counts(aggregate, self.aggregate())
+
+    def test_map_reduce(self):
+        paths = []
+        for index in range(3):
+            shard = tool.map_directory(self.directory, tool.ShardAggregate(k=5), tool.Decoder(), partition=(index, 3))
+            paths.append(os.path.join(self.temp, "shard{}.part".format(index)))
+            shard.save(paths[-1])
+        reduced = tool.reduce_partials(paths, "slowest")
+        serial = self.aggregate()
+        # The shards do not keep the listing order, so ids tied on a value may come in another order
+        self.assertEqual((reduced.documents, reduced.incomplete), (serial.documents, serial.incomplete))
+        for (pipeline_step, summary), expected_summary in zip(reduced.summaries().items(), serial.summaries().values()):
+            self.assertEqual(summary[:2], expected_summary[:2], pipeline_step)
+            self.assertAlmostEqual(summary[2], expected_summary[2], msg=pipeline_step)
+        self.assertEqual([time for _, time in reduced.top_times.items()], [time for _, time in serial.top_times.items()])
+        for top, expected_top in zip(reduced.step_top, serial.step_top):
+            self.assertEqual([time for _, time in top.items()], [time for _, time in expected_top.items()])
+
+    def test_shards_split_the_files(self):
+        shards = [{filename for filename in self.filenames if tool.in_shard(filename, partition=(index, 4))}
+                  for index in range(4)]
+        self.assertEqual(sum(len(shard) for shard in shards), len(self.filenames))
+        self.assertEqual(set.union(*shards), set(self.filenames))
+        self.assertTrue(all(tool.in_shard(filename, "0_*.json") == filename.startswith("0_") for filename in self.filenames))
+        self.assertEqual(tool.parse_partition("3/4"), (3, 4))
+        for value in ("4/4", "-1/4", "1", "a/b"):
+            with self.assertRaises(argparse.ArgumentTypeError, msg=value):
+                tool.parse_partition(value)
+
+    def test_reduce_refuses_other_partials(self):
+        path = os.path.join(self.temp, "small.part")
+        tool.ShardAggregate(k=5).save(path)
+        other_error = os.path.join(self.temp, "other-error.part")
+        tool.ShardAggregate(error=0.05, k=5).save(other_error)
+        damaged = os.path.join(self.temp, "damaged.part")
+        with open(path, "rb") as partial_file, open(damaged, "wb") as damaged_file:
+            damaged_file.write(partial_file.read()[:20])
+        for paths, k in (([path, other_error], None), ([path, damaged], None), ([path], 6)):
+            with self.assertRaises(ValueError, msg=paths):
+                tool.reduce_partials(paths, "slowest", k)
+
+    def test_profile(self):
+        profile_path = os.path.join(self.temp, "profile.json")
+        with contextlib.redirect_stdout(io.StringIO()):
+            tool.process_directory(self.directory, "slowest", profile_path=profile_path)
+        with open(profile_path) as profile_file:
+            profile = json.load(profile_file)
+        serial = self.aggregate()
+        # Every file is read and counted, the malformed ones are the errors
+        self.assertEqual((profile["files"], profile["documents"]), (len(self.filenames), serial.documents))
+        self.assertEqual(profile["errors"], len(self.filenames) - serial.documents)
+        self.assertEqual(profile["bytes"], sum(os.path.getsize(os.path.join(self.directory, filename))
+                                               for filename in self.filenames))
+        self.assertEqual(set(profile["phases"]), {"listing", "ingest", "read", "decode", "aggregate", "stats", "report"})
+        self.assertGreater(profile["files_per_second"], 0)
+        self.assertGreater(profile["peak_rss_bytes"], 0)
+
+
+class RollupIndexTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.temp = tempfile.mkdtemp()
+        cls.directory = os.path.join(cls.temp, "metrics")
+        generate(cls.directory, 300, seed=10, missing=0.02)
+        cls.filenames = tool.list_json_files(cls.directory)
+        cls.records = [record for _, record in tool.parse_batch(cls.directory, cls.filenames, tool.Decoder())]
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.temp)
+
+    def index(self, name):
+        index = tool.RollupIndex(os.path.join(self.temp, name), k=5)
+        self.addCleanup(index.close)
+        return index
+
+    # Aggregate of the records whose timestamps fall in [start, end): a step by the timestamp of the state ending it,
+    # the document by its last timestamp
+    def expected(self, start=0, end=2 ** 62):
+        aggregate = tool.Aggregate("slowest", True, k=5)
+        transitions = aggregate.transitions
+        for id, stats in self.records:
+            first = transitions.first_timestamps(stats)
+            for step, (v1, v2) in enumerate(transitions.pipelines):
+                if v1 in first and v2 in first and start <= first[v2] < end:
+                    aggregate.step_stats[step].add(first[v2] - first[v1])
+                    aggregate.step_top[step].add(first[v2] - first[v1], id)
+            if start <= max(timestamp for _, timestamp in stats) < end:
+                aggregate.documents += 1
+                aggregate.incomplete += len(first) < len(transitions.states)
+                aggregate.top_times.add(tool.processing_time(stats), id)
+        return aggregate
+
+    def assert_same_counts(self, aggregate, expected):
+        self.assertEqual((aggregate.documents, aggregate.incomplete), (expected.documents, expected.incomplete))
+        self.assertEqual([len(stats) for stats in aggregate.step_stats], [len(stats) for stats in expected.step_stats])
+        for summary, expected_summary in zip(aggregate.summaries().values(), expected.summaries().values()):
+            self.assertEqual(summary[:2], expected_summary[:2])
+            self.assertAlmostEqual(summary[2], expected_summary[2])
+        # Cells are merged in time order, so ids tied on a value may come in another order than the listing
+        self.assertEqual([time for _, time in aggregate.top_times.items()],
+                         [time for _, time in expected.top_times.items()])
+        for top, expected_top in zip(aggregate.step_top, expected.step_top):
+            self.assertEqual([time for _, time in top.items()], [time for _, time in expected_top.items()])
+
+    def test_cover(self):
+        minute, hour, day = (tool.BUCKETS[bucket] for bucket in ("minute", "hour", "day"))
+        start = 10 * day - 2 * minute
+        self.assertEqual(tool.RollupIndex.cover(start, 11 * day + hour + 2 * minute),
+                         [("minute", start), ("minute", start + minute), ("day", 10 * day), ("hour", 11 * day),
+                          ("minute", 11 * day + hour), ("minute", 11 * day + hour + minute)])
+        self.assertEqual(tool.RollupIndex.cover(start, start), [])
+
+    def test_ranges(self):
+        index = self.index("ranges.idx")
+        tool.update_index(index, self.directory, tool.Decoder())
+        self.assert_same_counts(index.query("slowest"), self.expected())
+        # A range on minute boundaries that is neither whole days nor whole hours
+        start = tool.parse_time("2020-01-10T13:17")
+        end = tool.parse_time("2020-01-21T04:41")
+        self.assert_same_counts(index.query("slowest", start=start, end=end), self.expected(start, end))
+        # The days of the range add up to the range
+        days = [index.query("slowest", start=day_start, end=day_end) for day_start, day_end in index.ranges("day", start, end)]
+        self.assertEqual(sum(aggregate.documents for aggregate in days), self.expected(start, end).documents)
+        # Adding the same files again changes nothing
+        tool.update_index(index, self.directory, tool.Decoder())
+        self.assertEqual(index.query("slowest").documents, len(self.records))
+
+    def test_undated_documents(self):
+        index = self.index("undated.idx")
+        index.add_records([("/a.json", (1, 1), ("a", [])), ("/b.json", (1, 1), ("b", []))])
+        index.add_records([("/c.json", (1, 1), ("c", [("NEW", 1577836800000)]))])
+        whole = index.query("slowest")
+        self.assertEqual((whole.documents, whole.incomplete), (3, 3))
+        self.assertEqual(whole.top_times.items(), [("a", 0), ("b", 0), ("c", 0)])
+        ranged = index.query("slowest", start=1577836800000, end=1577836860000)
+        self.assertEqual((ranged.documents, ranged.incomplete), (1, 1))
+
+    def test_cell_state(self):
+        cell = tool.RollupCell(0.01, 3)
+        cell.extend([5, 9, 7], ["a", "b", "c"])
+        # Up to k values the state is only the values and ids
+        self.assertEqual(cell.state(), ([5, 9, 7], ["a", "b", "c"], 0))
+        bigger = tool.RollupCell(0.01, 3)
+        bigger.extend([5, 9, 7, 1, 9], ["a", "b", "c", "d", "e"])
+        for state in (cell.state(), bigger.state()):
+            restored = tool.RollupCell.from_state(json.loads(json.dumps(state)), 0.01, 3)
+            self.assertEqual(restored.state(), state)
+        restored = tool.RollupCell.from_state(json.loads(json.dumps(bigger.state())), 0.01, 3)
+        restored.extend([9], ["f"])
+        self.assertEqual(restored.slowest.items(), [("b", 9), ("e", 9), ("f", 9)])
+        self.assertEqual(restored.fastest.items(), [("d", 1), ("a", 5), ("c", 7)])
+
+    def test_cells_are_json(self):
+        index = self.index("json.idx")
+        index.add_records([("/a.json", (1, 1), self.records[0])])
+        for (text,) in index.connection.execute("SELECT cell FROM cells"):
+            json.loads(text)
+
+    def test_other_error_is_refused(self):
+        path = os.path.join(self.temp, "error.idx")
+        tool.RollupIndex(path, error=0.02).close()
+        for error in (None, 0.02):
+            index = tool.RollupIndex(path, error=error)
+            self.assertEqual(index.error, 0.02)
+            index.close()
+        with self.assertRaises(ValueError):
+            tool.RollupIndex(path, error=0.01)
+        result = run_tool("-o", "slowest", "--index", path, "--error", "0.05", cwd=self.temp)
+        self.assertEqual(result.returncode, 2)
+        self.assertIn("was built with --error 0.02", result.stderr)
+        self.assertEqual(run_tool("-o", "slowest", "--index", path, cwd=self.temp).returncode, 0)
+
+    def test_earlier_index_is_refused(self):
+        path = os.path.join(self.temp, "earlier.idx")
+        index = tool.RollupIndex(path)
+        index.connection.execute("DELETE FROM settings WHERE name = 'format'")
+        index.connection.commit()
+        index.close()
+        with self.assertRaises(ValueError):
+            tool.RollupIndex(path)
+
+    def test_bucket_option(self):
+        path = os.path.join(self.temp, "bucket.idx")
+        result = run_tool("-d", self.directory, "-o", "fastest", "--index", path, "--from", "2020-01-05",
+                          "--to", "2020-01-08", "--bucket", "day", cwd=self.temp)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertEqual(result.stdout.count("Task 1:"), 3)
+        self.assertIn("2020-01-05 00:00:00 UTC - 2020-01-06 00:00:00 UTC", result.stdout)
+        # Queried again without the directory
+        result = run_tool("-o", "fastest", "--index", path, cwd=self.temp)
+        self.assertIn("Incomplete documents (missing a state of the pipeline graph): {} of {}".format(
+            self.expected().incomplete, len(self.records)), result.stdout)
+
+
+# Test.py (-e pandas) against the python engine with --exact, from the tables it prints
+class PandasEngineTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.temp = tempfile.mkdtemp()
+        cls.directory = os.path.join(cls.temp, "metrics")
+        generate(cls.directory, 200, seed=6, missing=0.03, malformed=0.02)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.temp)
+
+    # The rows of a printed table that name a pipeline step, as (step, fields before it, fields after it)
+    @staticmethod
+    def step_rows(lines):
+        rows = []
+        for line in lines:
+            fields = line.split()
+            if "->" in fields:
+                arrow = fields.index("->")
+                rows.append((" ".join(fields[arrow - 1:arrow + 2]), fields[:arrow - 1], fields[arrow + 2:]))
+        return rows
+
+    def test_same_statistics_as_the_python_engine(self):
+        import Test
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            Test.process_directory(self.directory, "slowest", 3)
+        task1, rest = output.getvalue().split("Task 2a:")
+        task2a = rest.split("Task 2b:")[0]
+
+        expected = tool.Aggregate("slowest", True, k=3)
+        tool.load_files(expected, self.directory, tool.list_json_files(self.directory), tool.Decoder())
+        summaries = expected.summaries()
+        rows = self.step_rows(task1.splitlines())
+        self.assertEqual([step for step, _, _ in rows], list(summaries))
+        for step, _, values in rows:
+            for value, expected_value in zip(values, summaries[step]):
+                self.assertAlmostEqual(float(value), expected_value, delta=1e-6 * abs(expected_value), msg=step)
+
+        tops = {}
+        for step, before, after in self.step_rows(task2a.splitlines()):
+            tops.setdefault(step, []).append((before[0], float(after[0])))
+        self.assertEqual(tops, {step: top.items() for step, top in expected.top.items()})
+
+    def test_python_only_options_are_refused(self):
+        result = run_tool("-d", self.directory, "-o", "slowest", "-e", "pandas", "--watch", "-s",
+                          os.path.join(self.temp, "store"), "--profile", os.path.join(self.temp, "profile.json"),
+                          cwd=self.temp)
+        self.assertEqual(result.returncode, 2)
+        self.assertIn("--watch, -s, --profile only apply to the python engine", result.stderr)
+        self.assertFalse(os.path.exists(os.path.join(self.temp, "store")))
+        for option in (["--exact"], ["-w", "2"], ["--cache", os.path.join(self.temp, "cache")]):
+            result = run_tool("-d", self.directory, "-o", "slowest", "-e", "spark", *option, cwd=self.temp)
+            self.assertEqual(result.returncode, 2, option)
+
+
+# --watch with --socket in a process of its own, queried while new files land in the directory
+class WatchTest(unittest.TestCase):
+    def setUp(self):
+        self.temp = tempfile.mkdtemp()
+        self.directory = os.path.join(self.temp, "metrics")
+        self.socket_path = os.path.join(self.temp, "query.sock")
+        generate(self.directory, 20, seed=7)
+        self.process = subprocess.Popen([sys.executable, os.path.abspath(tool.__file__), "-d", self.directory,
+                                         "-o", "slowest", "--watch", "--socket", self.socket_path,
+                                         "--interval", "0.05", "-w", "2"],
+                                        cwd=self.temp, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+
+    def tearDown(self):
+        if self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+        self.process.stderr.close()
+        shutil.rmtree(self.temp)
+
+    def query(self, command):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            client.connect(self.socket_path)
+            client.sendall((command + "\n").encode())
+            with client.makefile() as response:
+                return json.loads(response.readline())
+
+    # Query the status until it has the given number of documents
+    def wait_for_documents(self, documents):
+        deadline = time.monotonic() + 20
+        while time.monotonic() < deadline:
+            try:
+                status = self.query("status")
+                if status["documents"] == documents:
+                    return status
+            except (FileNotFoundError, ConnectionRefusedError):
+                pass
+            time.sleep(0.05)
+        self.fail("watch mode did not reach {} documents".format(documents))
+
+    def test_new_files_are_added_and_queried(self):
+        self.wait_for_documents(20)
+        generate(os.path.join(self.temp, "more"), 5, seed=8)
+        for filename in os.listdir(os.path.join(self.temp, "more")):
+            os.replace(os.path.join(self.temp, "more", filename), os.path.join(self.directory, filename))
+        self.assertEqual(self.wait_for_documents(25), {"documents": 25, "incomplete": 0, "steps": len(tool.pipelinesMap)})
+
+        expected = tool.Aggregate("slowest")
+        tool.load_files(expected, self.directory, tool.list_json_files(self.directory), tool.Decoder())
+        self.assertEqual(self.query("top")["processing_time"], [list(item) for item in expected.top_times.items()])
+        self.assertEqual(set(self.query("stats")), set(expected.summaries()))
+        self.assertIn("error", self.query("unknown"))
+
+        # SIGTERM shuts the server down and removes the socket
+        self.process.send_signal(signal.SIGTERM)
+        self.assertEqual(self.process.wait(timeout=20), 0)
+        self.assertFalse(os.path.exists(self.socket_path))
+        # The workers kept for the watch shut down quietly
+        self.assertNotIn("Traceback", self.process.stderr.read())
+
+
+class WatchSocketPathTest(unittest.TestCase):
+    def setUp(self):
+        self.temp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp)
+        self.directory = os.path.join(self.temp, "metrics")
+        generate(self.directory, 3, seed=11)
+
+    def test_a_file_is_not_replaced(self):
+        path = os.path.join(self.temp, "notes.txt")
+        with open(path, "w") as text_file:
+            text_file.write("not a socket")
+        result = run_tool("-d", self.directory, "-o", "slowest", "--watch", "--socket", path, cwd=self.temp)
+        self.assertEqual(result.returncode, 2)
+        self.assertIn("--socket must be a socket", result.stderr)
+        with open(path) as text_file:
+            self.assertEqual(text_file.read(), "not a socket")
+
+    def test_a_stale_socket_is_replaced(self):
+        path = os.path.join(self.temp, "stale.sock")
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as stale:
+            stale.bind(path)
+        self.assertTrue(tool.is_socket(path))
+        process = subprocess.Popen([sys.executable, os.path.abspath(tool.__file__), "-d", self.directory, "-o", "slowest",
+                                    "--watch", "--socket", path, "--interval", "0.05"],
+                                   cwd=self.temp, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            deadline = time.monotonic() + 20
+            while time.monotonic() < deadline:
+                try:
+                    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+                        client.connect(path)
+                        break
+                except (FileNotFoundError, ConnectionRefusedError):
+                    time.sleep(0.05)
+            else:
+                self.fail("watch mode did not listen on the stale socket path")
+        finally:
+            process.send_signal(signal.SIGTERM)
+            process.wait(timeout=20)
+        self.assertFalse(os.path.exists(path))
+
+
+if __name__ == '__main__':
+    unittest.main()